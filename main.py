@@ -1,6 +1,7 @@
 import logging
 import os
 import sys
+from collections import deque
 from typing import Dict
 
 from dotenv import load_dotenv
@@ -16,6 +17,7 @@ from telegram.ext import (
 
 from src.agent_core.graph import agent_app
 from src.agent_core.state import AgentState
+from src.gigachat_client import aclose_gigachat_client
 
 
 load_dotenv()
@@ -56,10 +58,12 @@ def get_initial_state() -> AgentState:
         plan_builder_result=None,
         analyzed_feedback=None,
         pinned_items={},
-        command_queue=[],
+        command_queue=deque(),
         city_id_afisha=None,
         parsed_dates_iso=None,
         parsed_end_dates_iso=None,
+        parsed_start_dt=None,
+        parsed_end_dt=None,
         user_start_coordinates=None,
         is_awaiting_address=False,
         status_message_id=None,
@@ -143,6 +147,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             del user_states[chat_id]
 
 
+async def shutdown(application: Application) -> None:
+    """Освобождает общие ресурсы при остановке бота."""
+    await aclose_gigachat_client()
+    logger.info("Клиент GigaChat закрыт.")
+
+
 def main() -> None:
     """Запускает бота."""
     telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -150,7 +160,9 @@ def main() -> None:
         logger.critical("Токен TELEGRAM_BOT_TOKEN не найден в .env файле!")
         sys.exit(1)
 
-    application = Application.builder().token(telegram_token).build()
+    application = (
+        Application.builder().token(telegram_token).post_shutdown(shutdown).build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(
@@ -20,6 +20,13 @@ import pymorphy3
 logger = logging.getLogger(__name__)
 morph = pymorphy3.MorphAnalyzer()
 
+# Первое число в строке среднего чека ("1000–1500 ₽")
+_FIRST_NUMBER_RE = re.compile(r"\d+")
+# Операторы сортировки: значение ограничения для них не вычисляется
+_SORT_OPERATORS = frozenset({"MIN", "MAX"})
+# Служебные фразы LLM о позиции, которые не являются поисковым запросом
+_POSITION_ONLY_PHRASES = frozenset({"после фильма", "до парка", "в конце"})
+
 
 class CommandProcessor:
     """
@@ -87,9 +94,11 @@ class CommandProcessor:
             if intent.command_type == "delete" and intent.target:
                 command = ChangeRequest(command="delete", target=intent.target)
                 self.executable_commands.append(command)
-                logger.debug(
-                    f"Сформирована команда на удаление: {command.model_dump_json()}"
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "Сформирована команда на удаление: %s",
+                        command.model_dump_json(),
+                    )
 
             elif intent.command_type == "add" and intent.target:
                 # --- УЛУЧШЕННАЯ ЛОГИКА 'add' ---
@@ -97,7 +106,7 @@ class CommandProcessor:
                 #    Иначе используем target как поисковый запрос.
                 query_details = intent.value_str
                 # Простой фильтр "мусорных" фраз от LLM
-                if query_details in ["после фильма", "до парка", "в конце"]:
+                if query_details in _POSITION_ONLY_PHRASES:
                     query_details = None
 
                 if not query_details:
@@ -117,9 +126,11 @@ class CommandProcessor:
                     command="add", new_activity=new_activity, position=position
                 )
                 self.executable_commands.append(command)
-                logger.debug(
-                    f"Сформирована команда на добавление: {command.model_dump_json()}"
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "Сформирована команда на добавление: %s",
+                        command.model_dump_json(),
+                    )
 
     def _process_modifications(self):
         """Обрабатывает команды на изменение атрибутов существующих элементов."""
@@ -142,7 +153,7 @@ class CommandProcessor:
         try:
             final_value = self._calculate_final_value(intent)
             # Для операторов MIN/MAX None - это нормальное значение
-            if final_value is None and intent.operator not in ["MIN", "MAX"]:
+            if final_value is None and intent.operator not in _SORT_OPERATORS:
                 raise ValueError("Не удалось вычислить финальное значение.")
         except Exception as e:
             logger.error(
@@ -167,9 +178,10 @@ class CommandProcessor:
         command = ChangeRequest(
             command="modify", target=intent.target, constraints=[constraint]
         )
-        logger.debug(
-            f"Сформирована команда на модификацию: {command.model_dump_json()}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Сформирована команда на модификацию: %s", command.model_dump_json()
+            )
         return command
 
     def _calculate_final_value(
@@ -200,7 +212,7 @@ class CommandProcessor:
             )
 
         elif intent.attribute == "price":
-            if intent.operator in ["MIN", "MAX"]:
+            if intent.operator in _SORT_OPERATORS:
                 return 0
 
             if intent.value_num is not None:
@@ -212,8 +224,8 @@ class CommandProcessor:
             if isinstance(current_item, FoodPlaceInfo):
                 if current_item.avg_bill_str:
                     # Извлекаем первое число из строки типа "1000–1500 ₽"
-                    match = re.search(
-                        r"\d+", current_item.avg_bill_str.replace(" ", "")
+                    match = _FIRST_NUMBER_RE.search(
+                        current_item.avg_bill_str.replace(" ", "")
                     )
                     if match:
                         return float(match.group(0))
@@ -236,7 +248,7 @@ class CommandProcessor:
             return current_item.name
 
         # Для операторов MIN/MAX не нужно конкретное значение
-        if intent.operator in ["MIN", "MAX"]:
+        if intent.operator in _SORT_OPERATORS:
             return None
 
         # Для других атрибутов (имя, рейтинг) просто возвращаем извлеченное значение
@@ -1,10 +1,20 @@
 import logging
 import asyncio
+import csv
+import hashlib
+import inspect
 import json
+import operator
 import re
+import sys
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import compress, repeat
+from time import monotonic
+from types import MappingProxyType
 from pydantic import BaseModel, Field
 from datetime import datetime, timedelta
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 from src.agent_core.command_processor import CommandProcessor
 from src.schemas.data_schemas import (
     ExtractedInitialInfo,
@@ -17,28 +27,406 @@ from src.schemas.data_schemas import (
     PlanBuilderResult,
     PossibleActions,
     SimplifiedExtractedInfo,
+    CombinedExtractedInfo,
     ActivityClassifier,
+    BatchActivityClassification,
     OrderedActivityItem,
     UserIntent,
     ChangeRequest,
     SemanticConstraint,
     ClassifiedIntent,
-    RouteSegment,
+    RouteSegmentDict,
 )
 
 from src.tools.datetime_parser_tool import datetime_parser_tool
 from src.tools.gis_tools import park_search_tool, food_place_search_tool
 from src.services.gis_service import get_geocoding_details, get_route
 from src.agent_core.state import AgentState
-from src.gigachat_client import get_gigachat_client
-from src.services.afisha_service import fetch_cities
+from src.agent_core.planner import PlanBuilder
+from src.config import settings
+from src.gigachat_client import (
+    bounded_ainvoke,
+    bounded_astream_until,
+    get_gigachat_client,
+    get_structured_llm,
+)
+from src.services.afisha_service import find_city_by_name
 from src.tools.event_search_tool import event_search_tool
 from langchain_core.messages import HumanMessage, AIMessage
-from src.utils.callbacks import TokenUsageCallbackHandler
+from src.utils.callbacks import get_token_callback
 
 logger = logging.getLogger(__name__)
 
-logger = logging.getLogger(__name__)
+
+# Общий пустой словарь только для чтения: значение по умолчанию для
+# отсутствующих полей состояния без создания нового {} на каждый вызов
+_EMPTY_MAP = MappingProxyType({})
+
+
+# === REGEX CONSTANTS ===
+
+# Используем re.DOTALL, чтобы . соответствовал и символу новой строки
+_COMMANDS_BLOCK_RE = re.compile(r"<commands>(.*?)</commands>", re.DOTALL)
+# Значение вида "2 часа" / "1500 рублей": число и (опционально) единица измерения
+_NUM_UNIT_RE = re.compile(r"(?P<num>[\d.]+)\s*(?P<unit>[а-яА-Яa-zA-Z]+)?")
+# Все, кроме букв, цифр, пробелов и дефиса, - для нормализации ключей кэша
+_CACHE_KEY_STRIP_RE = re.compile(r"[^\w\s-]+")
+# Первое число в строке среднего чека; пробелы внутри ("1 000") убираются из совпадения
+_PRICE_RE = re.compile(r"\d[\d\s]*")
+
+
+# === PROMPT CONSTANTS ===
+
+_CLARIFY_QUESTION_TEMPLATE = """{history_block}Ты — вежливый и услужливый помощник по планированию досуга. Твоя задача — запросить у пользователя недостающую информацию для поиска мероприятий.
+На основе текущего диалога и того, какие поля отсутствуют, сформулируй один короткий и точный вопрос.
+Если отсутствуют несколько полей, запроси их все в одном вопросе. Например: 'В каком городе и на какую дату вы хотели бы найти?'
+Избегай избыточной вежливости, будь прямолинеен, но дружелюбен.
+Не упоминай системные названия полей (city, dates_description, activity_type), используй естественный язык (город, дата, что именно).
+Текущие критерии:
+  Город: {city}
+  Дата: {date}
+  Активность: {activities}
+
+Недостающие данные: {missing}
+
+Сформулируй вопрос:"""
+
+_CLARIFICATION_EXTRACT_TEMPLATE = """{history_block}Ты — системный анализатор. Твоя задача — извлечь из ответа пользователя только ту информацию, которая относится к запросу уточнения.
+Мы запросили у пользователя следующие данные: {missing_fields}.
+Последний вопрос, который был задан: '{last_question}'
+Проанализируй ответ пользователя и извлеки соответствующие поля. Если ответ явно не относится к запросу, установи 'is_irrelevant' в True.
+Если пользователь предоставил активности, извлеки их как ОДНУ СТРОКУ, разделенную запятыми (для поля activities_str).
+Возвращай ТОЛЬКО JSON-объект.
+
+### Ответ пользователя:
+'{user_message}'"""
+
+_INTENT_PROMPT_TEMPLATE = """
+Ты — высокоточный системный диспетчер. Твоя задача — проанализировать запрос пользователя и четко классифицировать его намерение по ОДНОЙ из трех категорий.
+
+### Категории и Ключевые Признаки:
+1.  **PLAN_REQUEST**:
+    *   **Признаки:** В запросе есть упоминания **АКТИВНОСТЕЙ** (кино, парк, погулять, поесть, концерт, стендап), **МЕСТА** (город, адрес) или **ВРЕМЕНИ** (завтра, на выходных, в 15:00).
+    *   **ПРАВИЛО:** Если есть **хотя бы один** из этих признаков — это почти всегда `PLAN_REQUEST`.
+    *   **Примеры:**
+        - "Хочу на фильм и покушать послезавтра в Воронеже" -> PLAN_REQUEST
+        - "Найди стендап в Москве" -> PLAN_REQUEST
+        - "Чем заняться на выходных?" -> PLAN_REQUEST
+        - "Поесть в центре" -> PLAN_REQUEST
+
+2.  **FEEDBACK_ON_PLAN**:
+    *   **Признаки:** Пользователь отвечает на **только что предложенный план**. Ответ содержит прямые указания на изменение плана.
+    *   **Примеры:** "Поменяй ресторан на более дешевый", "А есть сеанс попозже?", "Убери парк", "Да, этот план подходит".
+
+3.  **CHITCHAT**:
+    *   **Признаки:** Запрос **НЕ содержит** признаков `PLAN_REQUEST` или `FEEDBACK_ON_PLAN`. Это общие фразы.
+    *   **Примеры:** "Привет", "Спасибо", "Что ты умеешь?", "Как дела?", "Ты бот?".
+
+### ЗАДАЧА:
+Проанализируй следующий запрос пользователя и верни JSON с категорией намерения.
+**Запрос:** "{user_query}"
+"""
+
+_RE_ASK_PROMPT_TEMPLATE = """
+Ты — вежливый и услужливый помощник. Пользователь ответил на твой вопрос '{last_question}' нерелевантным сообщением: '{user_message}'.
+Его ответ был: '{summary}'.
+Твоя задача — вежливо подтвердить, что ты услышал его, но мягко напомнить, что для продолжения тебе нужна запрошенная информация.
+Сформулируй короткий и дружелюбный ответ.
+Пример: "Я рад за вас, что у вас хороший компьютер, но для поиска спектакля мне все еще нужен город. Пожалуйста, напишите его."
+"""
+
+_PRESENTER_DRAFT_PROMPT_TEMPLATE = """Ты — "Голос" ассистента. Представь предварительный план и запроси адрес.
+### План (один пункт на строку, поля через "|"):
+{plan_text}
+### Задача:
+1. Начни с: "Вот что я смог для вас подобрать в качестве предварительного плана:".
+2. Структурированно выведи каждый пункт плана. Используй Markdown и эмодзи.
+3. **ПЕРЕД** каждым мероприятием, кроме первого, если у пункта указан переезд, добавь строку "⬇️ Переезд ~XX мин.".
+4. **В КОНЦЕ** дословно спроси: "📍 Откуда вы планируете начать ваш маршрут? Укажите адрес или напишите 'пропустить'." """
+
+_PRESENTER_FINAL_PROMPT_TEMPLATE = """Ты — "Голос" ассистента. Представь итоговый план с маршрутом.
+### План (один пункт на строку, поля через "|"):
+{plan_text}
+### Маршрут:
+{route_text}
+### Общее время в пути: {total_travel_minutes} минут.
+### Задача:
+1. Начни с: "Вот ваш итоговый план:".
+2. Красиво выведи пункты плана.
+3. Добавь заголовок "➡️ Маршрут:" и выведи под ним собранный маршрут.
+4. Добавь строку "🚗 Общее время в пути: ~{total_travel_minutes} мин".
+5. Заверши фразой: "План окончательный. Если захотите что-то изменить или начать новый поиск — просто напишите! 😊" """
+
+_FEEDBACK_ANALYSIS_PROMPT_TEMPLATE = """
+Ты — высокоточный системный аналитик. Твоя задача - проанализировать запрос пользователя на изменение плана, сначала пошагово рассуждая, а затем выдав четкие команды в специальном формате.
+
+### Контекст:
+- **Предложенный план:** {simplified_plan_json}
+- **Запрос пользователя:** "{user_query}"
+
+### ЗАДАЧА:
+Выполни два действия в указанном порядке:
+1.  **Внутри тега `<reasoning>`:** Напиши свои пошаговые рассуждения. Определи, сколько намерений у пользователя и что он хочет сделать с каждым элементом.
+2.  **Внутри тега `<commands>`:** Для каждого намерения напиши ОДНУ команду на новой строке в строго заданном формате с 6 полями, разделенными точкой с запятой. Используй 'None' для пустых полей.
+
+### Формат команды:
+`command_type;target;attribute;operator;value_str;value_num_unit`
+(value_num_unit - это число и единица измерения через пробел, например '2 часа' или '1500 рублей')
+
+### СЛОВАРЬ ТЕРМИНОВ:
+- **command_type**: `modify`, `delete`, `add`, `update_criteria`, `chitchat`.
+- **target**: `MOVIE`, `RESTAURANT`, `PARK`, `date`, `city`.
+- **attribute**: `start_time`, `price`, `rating`, `date`, `city`, `name`.
+- **operator**: `GREATER_THAN`, `LESS_THAN`, `NOT_EQUALS`, `MIN`, `MAX`.
+
+### ПРИМЕР:
+- **Запрос:** "Фильм слишком поздний, давай на часик пораньше. И ресторан найди подешевле, до 1500 рублей, а парк убери. И давай все в Казани."
+- **Твой ответ:**
+<reasoning>
+Пользователь выразил четыре намерения.
+1. Фильм: "на часик пораньше" - это изменение времени в меньшую сторону (modify, LESS_THAN).
+2. Ресторан: "подешевле, до 1500" - это изменение цены в меньшую сторону (modify, LESS_THAN).
+3. Парк: "убери" - это удаление (delete).
+4. Глобальное изменение: "в Казани" - это смена города (update_criteria), что является приоритетной командой.
+</reasoning>
+<commands>
+modify;MOVIE;start_time;LESS_THAN;None;1 час
+modify;RESTAURANT;price;LESS_THAN;None;1500 рублей
+delete;PARK;None;None;None;None
+update_criteria;city;city;None;Казань;None
+</commands>
+
+ЗАДАЧА: Проанализируй запрос и сгенерируй ответ в указанном формате.
+"""
+
+# Промпт анализа фидбека заранее разбит на статические части вокруг двух
+# подстановок: на каждый вызов остается одна склейка без разбора шаблона
+_FEEDBACK_PROMPT_HEAD, _, _FEEDBACK_PROMPT_REST = _FEEDBACK_ANALYSIS_PROMPT_TEMPLATE.partition(
+    "{simplified_plan_json}"
+)
+_FEEDBACK_PROMPT_MID, _, _FEEDBACK_PROMPT_TAIL = _FEEDBACK_PROMPT_REST.partition(
+    "{user_query}"
+)
+
+_CHITCHAT_PROMPT_TEMPLATE = """
+Ты — дружелюбный и услужливый ассистент по планированию досуга.
+Пользователь написал тебе сообщение, которое не является запросом на составление плана.
+Твоя задача — вежливо и по делу ответить ему.
+
+Ключевые моменты, которые нужно упомянуть в ответе:
+- Ты можешь помочь найти мероприятия (кино, концерты, стендапы), места для прогулок (парки) и отдыха.
+- Ты умеешь составлять из них последовательный план с учетом времени и маршрутов.
+- Предложи пользователю сформулировать свой запрос, например: "Найди мне стендап в Воронеже на этих выходных".
+
+Запрос пользователя: "{user_query}"
+
+Сформируй краткий, дружелюбный и полезный ответ.
+"""
+
+_EXTRACT_PROMPT_TEMPLATE = """
+Ты — системный анализатор. Твоя задача — извлечь из запроса пользователя ключевую информацию.
+Извлеки ВСЕ упоминания активностей (дел, занятий) как ОДНУ СТРОКУ, разделенную запятыми.
+
+### Пример 1:
+- Запрос: "Хочу на фильм и покушать еще в парке погулять послезавтра в воронеже"
+- Результат (JSON):
+  {{
+    "city": "Воронеж",
+    "dates_description": "послезавтра",
+    "activities_str": "фильм, покушать, в парке погулять"
+  }}
+
+### Пример 2:
+- Запрос: "Найди стендап в Москве на выходных, а потом сходим в бар"
+- Результат (JSON):
+  {{
+    "city": "Москва",
+    "dates_description": "на выходных",
+    "activities_str": "стендап, сходим в бар"
+  }}
+
+### ЗАДАЧА:
+Проанализируй следующий запрос пользователя и верни ТОЛЬКО JSON-объект.
+**Запрос:** "{user_query}"
+"""
+
+_ACTIVITY_TYPES_DESCRIPTION = """### Системные типы и их ключевые слова:
+- **MOVIE**: Кино, фильм, сеанс, кинотеатр.
+- **PARK**: Парк, сквер, погулять на природе, сад, набережная, аллея.
+- **RESTAURANT**: Поесть, покушать, ресторан, кафе, бар, ужин, обед, перекусить, выпить кофе.
+- **CONCERT**: Концерт, музыкальное выступление, опен-эйр.
+- **STAND_UP**: Стендап, комедийное шоу, открытый микрофон.
+- **PERFORMANCE**: Спектакль, театр, балет, опера.
+- **MUSEUM_EXHIBITION**: Музей, выставка, галерея, экспозиция.
+- **UNKNOWN**: Если не подходит ни один из вышеперечисленных.
+"""
+
+# Промпт классификации вызывается на каждую активность, поэтому он разбит на
+# неизменяемые префикс и суффикс вместо разбора шаблона через str.format.
+_ACTIVITY_CLASSIFY_PROMPT_PREFIX = (
+    """
+Твоя задача — классифицировать активность пользователя, выбрав ОДИН наиболее подходящий системный тип.
+"""
+    + _ACTIVITY_TYPES_DESCRIPTION
+    + """### ЗАДАЧА: Классифицируй следующую активность: \""""
+)
+_ACTIVITY_CLASSIFY_PROMPT_SUFFIX = '"\n'
+
+# Пакетная классификация: общий префикс один на все активности запроса
+_ACTIVITY_BATCH_CLASSIFY_PROMPT_PREFIX = (
+    """
+Твоя задача — классифицировать КАЖДУЮ из перечисленных активностей пользователя, выбрав для каждой ОДИН наиболее подходящий системный тип.
+"""
+    + _ACTIVITY_TYPES_DESCRIPTION
+    + """### ЗАДАЧА: Классифицируй следующие активности и верни ровно по одному результату на каждую, в том же порядке:
+"""
+)
+
+# Извлечение критериев и классификация активностей одним запросом к LLM
+_COMBINED_EXTRACT_PROMPT_TEMPLATE = (
+    """
+Ты — системный анализатор. Твоя задача — извлечь из запроса пользователя ключевую информацию
+и для КАЖДОЙ упомянутой активности (дела, занятия) выбрать ОДИН системный тип.
+"""
+    + _ACTIVITY_TYPES_DESCRIPTION
+    + """
+### Пример:
+- Запрос: "Хочу на фильм и покушать еще в парке погулять послезавтра в воронеже"
+- Результат (JSON):
+  {{
+    "city": "Воронеж",
+    "dates_description": "послезавтра",
+    "ordered_activities": [
+      {{"activity_type": "MOVIE", "query_details": "фильм"}},
+      {{"activity_type": "RESTAURANT", "query_details": "покушать"}},
+      {{"activity_type": "PARK", "query_details": "в парке погулять"}}
+    ]
+  }}
+
+### ЗАДАЧА:
+Проанализируй следующий запрос пользователя и верни ТОЛЬКО JSON-объект.
+Сохраняй порядок активностей, в котором их упомянул пользователь.
+**Запрос:** "{user_query}"
+"""
+)
+
+# Однозначные корни слов -> тип активности. Позволяют не вызывать LLM
+# для очевидных формулировок вроде "кино" или "погулять в парке".
+# Корень должен стоять в начале слова (см. _ACTIVITY_KEYWORD_RE).
+_ACTIVITY_KEYWORDS = {
+    "кино": "MOVIE",
+    "фильм": "MOVIE",
+    "мультфильм": "MOVIE",
+    "сеанс": "MOVIE",
+    "парк": "PARK",
+    "сквер": "PARK",
+    "набережн": "PARK",
+    "аллея": "PARK",
+    "погулять": "PARK",
+    "прогул": "PARK",
+    "ресторан": "RESTAURANT",
+    "кафе": "RESTAURANT",
+    "кофейн": "RESTAURANT",
+    "поесть": "RESTAURANT",
+    "покушать": "RESTAURANT",
+    "перекус": "RESTAURANT",
+    "завтрак": "RESTAURANT",
+    "обед": "RESTAURANT",
+    "пообедать": "RESTAURANT",
+    "ужин": "RESTAURANT",
+    "поужинать": "RESTAURANT",
+    "концерт": "CONCERT",
+    "стендап": "STAND_UP",
+    "стенд-ап": "STAND_UP",
+    "спектакл": "PERFORMANCE",
+    "театр": "PERFORMANCE",
+    "балет": "PERFORMANCE",
+    "музей": "MUSEUM_EXHIBITION",
+    "выставк": "MUSEUM_EXHIBITION",
+    "галере": "MUSEUM_EXHIBITION",
+}
+# Один проход по строке вместо проверки каждого корня через `in`.
+# Длинные корни идут первыми, чтобы выбиралось самое длинное совпадение.
+_ACTIVITY_KEYWORD_RE = re.compile(
+    r"\b(?:"
+    + "|".join(
+        re.escape(keyword) for keyword in sorted(_ACTIVITY_KEYWORDS, key=len, reverse=True)
+    )
+    + ")"
+)
+
+# === ROUTING CONSTANTS ===
+
+# Тип команды из очереди -> действие роутера
+_COMMAND_ACTION_MAP = MappingProxyType(
+    {
+        "modify": PossibleActions.REFINE_PLAN,
+        "delete": PossibleActions.DELETE_ACTIVITY,
+        "add": PossibleActions.ADD_ACTIVITY,
+        "update_criteria": PossibleActions.SEARCH_EVENTS,
+    }
+)
+
+# Неизменяемая часть полного сброса состояния при новом PLAN_REQUEST.
+# Изменяемые контейнеры (кэш, закрепленные элементы, списки) создаются
+# заново при каждом сбросе, так как узлы дополняют их на месте.
+_PLAN_REQUEST_RESET = MappingProxyType(
+    {
+        "search_criteria": None,
+        "current_plan": None,
+        "plan_builder_result": None,
+        "user_start_address": None,
+        "user_start_coordinates": None,
+        "is_awaiting_start_address": False,
+        "is_awaiting_criteria_clarification": False,
+        "last_clarification_question": None,
+        "next_action": PossibleActions.EXTRACT_CRITERIA,
+    }
+)
+
+# Операторы сортировки: задают предпочтение, а не фильтр кандидатов
+_SORT_OPERATORS = frozenset({"MIN", "MAX"})
+
+# Типы активностей, которые ищутся через Афишу (event_search_tool)
+_EVENT_ACTIVITY_TYPES = frozenset(
+    {"MOVIE", "CONCERT", "PERFORMANCE", "STAND_UP", "MUSEUM_EXHIBITION"}
+)
+
+# Тип активности -> инструменты поиска для add_activity_node
+_ADD_ACTIVITY_SEARCH_TOOLS = {
+    "PARK": [park_search_tool],
+    "RESTAURANT": [food_place_search_tool],
+}
+
+# Тип активности -> модель кандидата (остальные типы из Афиши -> Event)
+_CANDIDATE_MODEL_BY_ACTIVITY = {
+    "PARK": ParkInfo,
+    "RESTAURANT": FoodPlaceInfo,
+}
+
+
+def _format_history_block(messages: list) -> str:
+    """Форматирует последние сообщения диалога в блок-преамбулу для промпта."""
+    if not messages:
+        return ""
+    lines = "\n".join(
+        f"{'Пользователь' if isinstance(msg, HumanMessage) else 'Ассистент'}: {msg.content}"
+        for msg in messages
+    )
+    return f"Вот последние сообщения из нашего диалога:\n{lines}\n\nНа основе этого:\n"
+
+
+def _store_parsed_dates(state: AgentState, parsed_time: Optional[dict]) -> None:
+    """
+    Сохраняет результат datetime_parser_tool в состояние: ISO-строки для
+    сериализации и готовые datetime, чтобы узлы не парсили их повторно.
+    """
+    start_iso = parsed_time.get("datetime_iso") if parsed_time else None
+    end_iso = parsed_time.get("end_datetime_iso") if parsed_time else None
+    state["parsed_dates_iso"] = [start_iso] if start_iso else []
+    state["parsed_end_dates_iso"] = [end_iso] if end_iso else []
+    state["parsed_start_dt"] = datetime.fromisoformat(start_iso) if start_iso else None
+    state["parsed_end_dt"] = datetime.fromisoformat(end_iso) if end_iso else None
 
 
 class ClarifiedInfo(BaseModel):
@@ -53,6 +441,220 @@ class ClarifiedInfo(BaseModel):
 
 
 
+def _normalize_cache_key(text: str) -> str:
+    """
+    Нормализует пользовательскую формулировку для ключа кэша классификаций:
+    регистр, "ё", пунктуация и лишние пробелы не влияют на результат.
+    """
+    text = _CACHE_KEY_STRIP_RE.sub(" ", text.lower().replace("ё", "е"))
+    return " ".join(text.split())
+
+
+def _lru_get(cache: OrderedDict, key):
+    """Возвращает значение из LRU-кэша (или None), отмечая его как свежее."""
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _lru_put(cache: OrderedDict, key, value, max_size: int) -> None:
+    """Кладет значение в LRU-кэш, вытесняя самое старое при переполнении."""
+    cache[key] = value
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+# LRU-кэш классификаций активностей на весь процесс: формулировки вроде
+# "ресторан" или "парк" повторяются у разных пользователей постоянно.
+_ACTIVITY_TYPE_CACHE_SIZE = 1024
+_activity_type_cache: "OrderedDict[str, str]" = OrderedDict()
+
+# LRU-кэш намерений: приветствия и типовые фразы повторяются постоянно.
+# Ключ учитывает наличие предложенного плана - это часть контекста промпта.
+_INTENT_CACHE_SIZE = 512
+_intent_cache: "OrderedDict[Tuple[str, bool], ClassifiedIntent]" = OrderedDict()
+
+# Кэш текстов презентации плана: ключ - хэш промпта, значение - (истекает, текст).
+# TTL ограничивает жизнь текста, в котором могли устареть сеансы и цены.
+_PRESENTATION_CACHE_SIZE = 512
+_PRESENTATION_CACHE_TTL_SECONDS = 3600
+_presentation_cache: "OrderedDict[bytes, Tuple[float, str]]" = OrderedDict()
+
+# Кэш разметки команд analyze_feedback_node: (нормализованный запрос,
+# контекст плана из промпта) -> ответ LLM с блоком <commands>
+_FEEDBACK_MARKUP_CACHE_SIZE = 256
+_feedback_markup_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+# Правила для очевидных запросов, которые не требуют LLM.
+# Сравниваются с нормализованным запросом (см. _normalize_cache_key).
+_CHITCHAT_PHRASES = frozenset(
+    {
+        "привет",
+        "приветик",
+        "здравствуй",
+        "здравствуйте",
+        "добрый день",
+        "добрый вечер",
+        "доброе утро",
+        "хай",
+        "спасибо",
+        "спасибо большое",
+        "благодарю",
+        "пока",
+        "до свидания",
+        "как дела",
+        "как ты",
+        "кто ты",
+        "ты бот",
+        "что ты умеешь",
+        "что умеешь",
+    }
+)
+# Правило PLAN_REQUEST требует обеих групп: активность или слово о
+# планировании И время/место. Одно лишь "завтра" бывает и болтовней
+# ("завтра будет дождь?") - такие запросы решает LLM
+_PLAN_ACTIVITY_KEYWORDS_RE = re.compile(
+    r"\b(?:кино\w*|фильм\w*|парк\w*|ресторан\w*|кафе|стендап\w*|концерт\w*"
+    r"|спектакл\w*|театр\w*|выставк\w*|погулять|прогул\w+|поесть|покушать"
+    r"|план\w*|сходить|куда\s+пойти|досуг\w*)\b"
+)
+_PLAN_WHEN_WHERE_KEYWORDS_RE = re.compile(
+    r"\b(?:завтра|послезавтра|сегодня|вечером|утром|днем|выходн\w+|в\s+\w+ске)\b"
+)
+
+
+def _lookup_activity_type(activity_str: str) -> Optional[str]:
+    """
+    Определяет тип активности без LLM: по кэшу или по однозначным ключевым словам.
+    Возвращает None, если нужна классификация через LLM.
+    """
+    cache_key = _normalize_cache_key(activity_str)
+    if (cached_type := _lru_get(_activity_type_cache, cache_key)) is not None:
+        logger.info(f"Активность '{activity_str}' взята из кэша: {cached_type}")
+        return cached_type
+
+    # Если ключевые слова указывают ровно на один тип, LLM не нужна.
+    # Корни ищутся с начала слова: "кинотеатр" - это MOVIE, а не PERFORMANCE,
+    # "победа" не совпадает с "обед". Неоднозначные случаи решает LLM.
+    keyword_types = {
+        _ACTIVITY_KEYWORDS[match.group()]
+        for match in _ACTIVITY_KEYWORD_RE.finditer(cache_key)
+    }
+    if len(keyword_types) == 1:
+        keyword_type = keyword_types.pop()
+        logger.info(f"Активность '{activity_str}' классифицирована по ключевому слову: {keyword_type}")
+        return keyword_type
+    return None
+
+
+def _remember_activity_type(activity_str: str, activity_type: str) -> None:
+    """Сохраняет результат LLM-классификации в LRU-кэш активностей."""
+    _lru_put(
+        _activity_type_cache,
+        _normalize_cache_key(activity_str),
+        activity_type,
+        _ACTIVITY_TYPE_CACHE_SIZE,
+    )
+
+
+async def _classify_activity(activity_str: str, callback_prefix: str) -> str:
+    """Классифицирует одну активность пользователя в системный тип."""
+    if (known_type := _lookup_activity_type(activity_str)) is not None:
+        return known_type
+
+    activity_classifier = get_structured_llm(ActivityClassifier)
+    # Обработчик общий для узла: текст активности идет в лог, а не в ключ
+    token_callback = get_token_callback(callback_prefix)
+    prompt = f"{_ACTIVITY_CLASSIFY_PROMPT_PREFIX}{activity_str}{_ACTIVITY_CLASSIFY_PROMPT_SUFFIX}"
+    classified_activity = await bounded_ainvoke(
+        activity_classifier, prompt, config={"callbacks": [token_callback]}
+    )
+    logger.info(
+        f"{callback_prefix}: активность '{activity_str}' классифицирована как {classified_activity.activity_type}"
+    )
+    _remember_activity_type(activity_str, classified_activity.activity_type)
+    return classified_activity.activity_type
+
+
+async def _classify_activities_batch(
+    activities_list: List[str], callback_prefix: str
+) -> Optional[List[str]]:
+    """
+    Классифицирует несколько активностей одним запросом к LLM.
+    Возвращает типы в исходном порядке или None, если ответ непригоден.
+    """
+    batch_classifier = get_structured_llm(BatchActivityClassification)
+    token_callback = get_token_callback(f"{callback_prefix}_batch")
+    numbered = "\n".join(
+        f'{i}. "{activity_str}"' for i, activity_str in enumerate(activities_list, 1)
+    )
+    try:
+        result = await bounded_ainvoke(
+            batch_classifier,
+            f"{_ACTIVITY_BATCH_CLASSIFY_PROMPT_PREFIX}{numbered}\n",
+            config={"callbacks": [token_callback]},
+        )
+    except Exception as e:
+        logger.warning(f"Пакетная классификация активностей не удалась: {e}")
+        return None
+
+    if len(result.items) != len(activities_list):
+        logger.warning(
+            f"Пакетная классификация вернула {len(result.items)} результатов вместо {len(activities_list)}."
+        )
+        return None
+
+    activity_types = [item.activity_type for item in result.items]
+    for activity_str, activity_type in zip(activities_list, activity_types):
+        logger.info(f"Активность '{activity_str}' классифицирована как {activity_type}")
+        _remember_activity_type(activity_str, activity_type)
+    return activity_types
+
+
+async def _classify_activities(
+    activities_list: List[str], callback_prefix: str
+) -> List[OrderedActivityItem]:
+    """
+    Классифицирует все активности за один round-trip: то, что не решается
+    кэшем и ключевыми словами, уходит в LLM одним пакетным запросом
+    (при неудаче - параллельными запросами по одной активности).
+    Сохраняет исходный порядок и отбрасывает нераспознанные (UNKNOWN)
+    и те, классификация которых завершилась ошибкой.
+    """
+    resolved = {act: _lookup_activity_type(act) for act in activities_list}
+    pending = [act for act, activity_type in resolved.items() if activity_type is None]
+
+    if len(pending) > 1 and (
+        batch_types := await _classify_activities_batch(pending, callback_prefix)
+    ):
+        resolved.update(zip(pending, batch_types))
+        pending = []
+
+    if pending:
+        single_types = await asyncio.gather(
+            *(_classify_activity(act, callback_prefix) for act in pending),
+            return_exceptions=True,
+        )
+        resolved.update(zip(pending, single_types))
+
+    ordered_activities = []
+    for activity_str in activities_list:
+        activity_type = resolved[activity_str]
+        if isinstance(activity_type, Exception):
+            logger.warning(
+                f"Не удалось классифицировать активность '{activity_str}': {activity_type}"
+            )
+            continue
+        if activity_type != "UNKNOWN":
+            ordered_activities.append(
+                OrderedActivityItem(
+                    activity_type=activity_type, query_details=activity_str
+                )
+            )
+    return ordered_activities
+
+
 async def check_and_ask_for_missing_criteria_node(state: AgentState) -> AgentState:
     """
     Проверяет наличие обязательных критериев (город, дата, активность).
@@ -62,15 +664,13 @@ async def check_and_ask_for_missing_criteria_node(state: AgentState) -> AgentSta
     logger.info("--- УЗЕЛ: check_and_ask_for_missing_criteria_node (v2.0) ---")
 
     search_criteria: Optional[ExtractedInitialInfo] = state.get("search_criteria")
-    chat_history = state.get("chat_history", [])
+    # Только чтение: пустой кортеж вместо нового списка на каждый вызов
+    chat_history = state.get("chat_history") or ()
 
     # Инициализируем новые поля, если их нет
-    if "is_awaiting_criteria_clarification" not in state:
-        state["is_awaiting_criteria_clarification"] = False
-    if "missing_criteria_fields" not in state:
-        state["missing_criteria_fields"] = []
-    if "last_clarification_question" not in state:
-        state["last_clarification_question"] = None
+    state.setdefault("is_awaiting_criteria_clarification", False)
+    state.setdefault("missing_criteria_fields", [])
+    state.setdefault("last_clarification_question", None)
 
     if not search_criteria:
         missing = ["city", "dates_description", "activity_type"]
@@ -97,37 +697,25 @@ async def check_and_ask_for_missing_criteria_node(state: AgentState) -> AgentSta
         state["next_action"] = PossibleActions.ASK_FOR_CRITERIA_CLARIFICATION
 
         llm = get_gigachat_client()
-        token_callback = TokenUsageCallbackHandler(node_name="ask_clarification_prompt")
-
-        prompt_parts = [
-            "Ты — вежливый и услужливый помощник по планированию досуга. Твоя задача — запросить у пользователя недостающую информацию для поиска мероприятий.",
-            "На основе текущего диалога и того, какие поля отсутствуют, сформулируй один короткий и точный вопрос.",
-            "Если отсутствуют несколько полей, запроси их все в одном вопросе. Например: 'В каком городе и на какую дату вы хотели бы найти?'",
-            "Избегай избыточной вежливости, будь прямолинеен, но дружелюбен.",
-            "Не упоминай системные названия полей (city, dates_description, activity_type), используй естественный язык (город, дата, что именно).",
-            "Текущие критерии:",
-            f"  Город: {search_criteria.city if search_criteria.city else 'не указан'}",
-            f"  Дата: {search_criteria.dates_description if search_criteria.dates_description else 'не указана'}",
-            f"  Активность: {', '.join([act.query_details for act in search_criteria.ordered_activities]) if search_criteria.ordered_activities else 'не указана'}",
-            "\nНедостающие данные: " + ", ".join([
-                "город" if "city" in missing_fields else "",
-                "дату" if "dates_description" in missing_fields else "",
-                "что именно вы хотите найти (кино, театр, концерт и т.д.)" if "activity_type" in missing_fields else ""
-            ]).strip().replace(", ,", ",").strip(", "),
-            "\nСформулируй вопрос:"
-        ]
-        
-        relevant_history = chat_history[-2:] if len(chat_history) > 2 else chat_history
-        if relevant_history:
-            prompt_parts.insert(0, "Вот последние сообщения из нашего диалога:")
-            for msg in relevant_history:
-                prompt_parts.append(f"{'Пользователь' if isinstance(msg, HumanMessage) else 'Ассистент'}: {msg.content}")
-            prompt_parts.append("\nНа основе этого:")
+        token_callback = get_token_callback("ask_clarification_prompt")
+
+        missing_description = ", ".join([
+            "город" if "city" in missing_fields else "",
+            "дату" if "dates_description" in missing_fields else "",
+            "что именно вы хотите найти (кино, театр, концерт и т.д.)" if "activity_type" in missing_fields else ""
+        ]).strip().replace(", ,", ",").strip(", ")
 
-        clarification_question_prompt = "\n".join(prompt_parts)
+        relevant_history = chat_history[-2:] if len(chat_history) > 2 else chat_history
+        clarification_question_prompt = _CLARIFY_QUESTION_TEMPLATE.format(
+            history_block=_format_history_block(relevant_history),
+            city=search_criteria.city if search_criteria.city else 'не указан',
+            date=search_criteria.dates_description if search_criteria.dates_description else 'не указана',
+            activities=', '.join([act.query_details for act in search_criteria.ordered_activities]) if search_criteria.ordered_activities else 'не указана',
+            missing=missing_description,
+        )
 
         try:
-            response = await llm.ainvoke(clarification_question_prompt, config={"callbacks": [token_callback]})
+            response = await bounded_ainvoke(llm, clarification_question_prompt, config={"callbacks": [token_callback]})
             question = response.content.strip()
             state["last_clarification_question"] = question
             logger.info(f"Сгенерирован вопрос для уточнения: '{question}'")
@@ -166,7 +754,7 @@ async def process_clarification_node(state: AgentState) -> AgentState:
     search_criteria: Optional[ExtractedInitialInfo] = state.get("search_criteria")
     missing_fields: List[str] = state.get("missing_criteria_fields", [])
     last_question: Optional[str] = state.get("last_clarification_question")
-    chat_history = state.get("chat_history", [])
+    chat_history = state.get("chat_history") or ()
 
     if not search_criteria:
         logger.error("process_clarification_node вызван без search_criteria. Возвращаемся к извлечению.")
@@ -176,51 +764,37 @@ async def process_clarification_node(state: AgentState) -> AgentState:
         state["last_clarification_question"] = None
         return state
 
-    llm = get_gigachat_client()
-    token_callback = TokenUsageCallbackHandler(node_name="process_clarification_extract")
-
-    # Формируем промпт для извлечения уточненных данных
-    prompt_parts = [
-        "Ты — системный анализатор. Твоя задача — извлечь из ответа пользователя только ту информацию, которая относится к запросу уточнения.",
-        "Мы запросили у пользователя следующие данные: " + ", ".join(missing_fields) + ".",
-        f"Последний вопрос, который был задан: '{last_question}'",
-        "Проанализируй ответ пользователя и извлеки соответствующие поля. Если ответ явно не относится к запросу, установи 'is_irrelevant' в True.",
-        "Если пользователь предоставил активности, извлеки их как ОДНУ СТРОКУ, разделенную запятыми (для поля activities_str).",
-        "Возвращай ТОЛЬКО JSON-объект.",
-        "\n### Ответ пользователя:",
-        f"'{user_message}'",
-    ]
-    
-    # Добавляем последние сообщения для контекста
-    relevant_history = chat_history[-4:] if len(chat_history) > 4 else chat_history
-    if relevant_history:
-        prompt_parts.insert(0, "Вот последние сообщения из нашего диалога:")
-        for msg in relevant_history:
-            prompt_parts.append(f"{'Пользователь' if isinstance(msg, HumanMessage) else 'Ассистент'}: {msg.content}")
-        prompt_parts.append("\nНа основе этого:")
+    token_callback = get_token_callback("process_clarification_extract")
 
-    clarification_extractor_prompt = "\n".join(prompt_parts)
+    # Формируем промпт для извлечения уточненных данных,
+    # добавляя последние сообщения для контекста
+    relevant_history = chat_history[-4:] if len(chat_history) > 4 else chat_history
+    clarification_extractor_prompt = _CLARIFICATION_EXTRACT_TEMPLATE.format(
+        history_block=_format_history_block(relevant_history),
+        missing_fields=", ".join(missing_fields),
+        last_question=last_question,
+        user_message=user_message,
+    )
 
     try:
-        extractor = llm.with_structured_output(ClarifiedInfo)
-        clarified_data: ClarifiedInfo = await extractor.ainvoke(
-            clarification_extractor_prompt, config={"callbacks": [token_callback]}
+        extractor = get_structured_llm(ClarifiedInfo)
+        clarified_data: ClarifiedInfo = await bounded_ainvoke(
+            extractor, clarification_extractor_prompt, config={"callbacks": [token_callback]}
         )
-        logger.info(f"Извлеченные уточненные данные: {clarified_data.model_dump_json(indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Извлеченные уточненные данные: {clarified_data.model_dump()}")
 
         if clarified_data.is_irrelevant:
             logger.info("Ответ пользователя признан нерелевантным.")
             # Генерируем вежливый повторный запрос
             re_ask_llm = get_gigachat_client()
-            re_ask_callback = TokenUsageCallbackHandler(node_name="re_ask_irrelevant")
-            re_ask_prompt = f"""
-Ты — вежливый и услужливый помощник. Пользователь ответил на твой вопрос '{last_question}' нерелевантным сообщением: '{user_message}'.
-Его ответ был: '{clarified_data.irrelevant_response_summary or user_message[:50]}'.
-Твоя задача — вежливо подтвердить, что ты услышал его, но мягко напомнить, что для продолжения тебе нужна запрошенная информация.
-Сформулируй короткий и дружелюбный ответ.
-Пример: "Я рад за вас, что у вас хороший компьютер, но для поиска спектакля мне все еще нужен город. Пожалуйста, напишите его."
-"""
-            re_ask_response = await re_ask_llm.ainvoke(re_ask_prompt, config={"callbacks": [re_ask_callback]})
+            re_ask_callback = get_token_callback("re_ask_irrelevant")
+            re_ask_prompt = _RE_ASK_PROMPT_TEMPLATE.format(
+                last_question=last_question,
+                user_message=user_message,
+                summary=clarified_data.irrelevant_response_summary or user_message[:50],
+            )
+            re_ask_response = await bounded_ainvoke(re_ask_llm, re_ask_prompt, config={"callbacks": [re_ask_callback]})
             state["chat_history"].append(AIMessage(content=re_ask_response.content.strip()))
             # Состояние ожидания остается прежним, так как данные не получены
             state["next_action"] = PossibleActions.ASK_FOR_CRITERIA_CLARIFICATION
@@ -242,53 +816,26 @@ async def process_clarification_node(state: AgentState) -> AgentState:
             parsed_result = await datetime_parser_tool.ainvoke(
                 {"natural_language_date": clarified_data.dates_description}
             )
+            _store_parsed_dates(state, parsed_result)
             if parsed_result:
-                state["parsed_dates_iso"] = [parsed_result["datetime_iso"]] if parsed_result["datetime_iso"] else []
-                state["parsed_end_dates_iso"] = [parsed_result["end_datetime_iso"]] if parsed_result["end_datetime_iso"] else []
                 logger.info(f"Даты успешно распарсены с помощью datetime_parser_tool: начало={state['parsed_dates_iso']}, конец={state['parsed_end_dates_iso']}")
             else:
-                state["parsed_dates_iso"] = []
-                state["parsed_end_dates_iso"] = []
                 logger.warning(f"datetime_parser_tool не смог распарсить дату: '{clarified_data.dates_description}'")
 
             updated = True
             logger.info(f"Обновлено описание даты: {search_criteria.dates_description}")
 
 
-
-
-
-        if "activity_type" in missing_fields and clarified_data.activities_str:
-            # Если получили строку активностей, нужно ее классифицировать
-            activities_list = [act.strip() for act in clarified_data.activities_str.split(",") if act.strip()]
-            if activities_list:
-                activity_classifier = llm.with_structured_output(ActivityClassifier)
-                new_ordered_activities = []
-                for activity_str in activities_list:
-                    classify_callback = TokenUsageCallbackHandler(node_name=f"classify_clarified_activity_{activity_str[:10]}")
-                    classify_prompt = f"""
-Твоя задача — классифицировать активность пользователя, выбрав ОДИН наиболее подходящий системный тип.
-### Системные типы и их ключевые слова:
-- **MOVIE**: Кино, фильм, сеанс, кинотеатр.
-- **PARK**: Парк, сквер, погулять на природе, сад, набережная, аллея.
-- **RESTAURANT**: Поесть, покушать, ресторан, кафе, бар, ужин, обед, перекусить, выпить кофе.
-- **CONCERT**: Концерт, музыкальное выступление, опен-эйр.
-- **STAND_UP**: Стендап, комедийное шоу, открытый микрофон.
-- **PERFORMANCE**: Спектакль, театр, балет, опера.
-- **MUSEUM_EXHIBITION**: Музей, выставка, галерея, экспозиция.
-- **UNKNOWN**: Если не подходит ни один из вышеперечисленных.
-### ЗАДАЧА: Классифицируй следующую активность: "{activity_str}"
-"""
-                    classified_activity = await activity_classifier.ainvoke(
-                        classify_prompt, config={"callbacks": [classify_callback]}
-                    )
-                    if classified_activity.activity_type != "UNKNOWN":
-                        new_ordered_activities.append(
-                            OrderedActivityItem(
-                                activity_type=classified_activity.activity_type,
-                                query_details=activity_str,
-                            )
-                        )
+
+
+
+        if "activity_type" in missing_fields and clarified_data.activities_str:
+            # Если получили строку активностей, нужно ее классифицировать
+            activities_list = [act.strip() for act in clarified_data.activities_str.split(",") if act.strip()]
+            if activities_list:
+                new_ordered_activities = await _classify_activities(
+                    activities_list, callback_prefix="classify_clarified_activity"
+                )
                 if new_ordered_activities:
                     search_criteria.ordered_activities = new_ordered_activities
                     updated = True
@@ -325,6 +872,63 @@ async def process_clarification_node(state: AgentState) -> AgentState:
     return state
 
 
+def _plan_item_coords(item: dict) -> Optional[Dict[str, float]]:
+    """Координаты элемента плана: coords у мест 2ГИС, place_coords_* у событий."""
+    if coords := item.get("coords"):
+        return {"lon": coords[0], "lat": coords[1]}
+    if item.get("place_coords_lon"):
+        return {"lon": item["place_coords_lon"], "lat": item["place_coords_lat"]}
+    return None
+
+
+def _compact_plan_item(index: int, item: dict) -> str:
+    """Одна строка плана для промпта: тип, время, название и ключевые детали."""
+    if "session_id" in item:
+        start = item.get("start_time_naive_event_tz")
+        if isinstance(start, datetime):
+            start = start.strftime("%d.%m %H:%M")
+        price = item.get("price_text") or (
+            f"от {item['min_price']}₽" if item.get("min_price") else None
+        )
+        fields = [
+            f"{item.get('user_event_type_key', 'EVENT')} @ {start}",
+            f"«{item.get('name')}»",
+            item.get("place_name"),
+            item.get("place_address"),
+            price,
+            f"рейтинг {item['rating']}" if item.get("rating") else None,
+        ]
+    elif "avg_bill_str" in item:
+        fields = [
+            "RESTAURANT",
+            f"«{item.get('name')}»",
+            item.get("address"),
+            item.get("avg_bill_str"),
+            item.get("rating_str"),
+            item.get("schedule_str"),
+        ]
+    else:
+        fields = [
+            "PARK",
+            f"«{item.get('name')}»",
+            item.get("address"),
+            item.get("schedule_str"),
+        ]
+    if travel := item.get("travel_info_to_here"):
+        fields.append(f"переезд ~{round((travel.get('duration_seconds') or 0) / 60)} мин")
+    return f"{index}. " + " | ".join([field for field in fields if field])
+
+
+def _compact_plan(plan) -> str:
+    """
+    Компактное табличное представление плана для промптов: одна строка на пункт.
+    Короче JSON в токенах и не требует рекурсивной сериализации pydantic.
+    """
+    return "\n".join(
+        [_compact_plan_item(index, item) for index, item in enumerate(plan.items, 1)]
+    )
+
+
 async def _recalculate_all_route_segments(plan, state) -> None:
     """
     Пересчитывает все маршруты между элементами плана.
@@ -336,61 +940,64 @@ async def _recalculate_all_route_segments(plan, state) -> None:
 
     logger.info(f"Пересчитываю маршруты для {len(plan.items)} элементов плана...")
 
+    # Сначала собираем отрезки, которые нужно построить, затем строим их разом
+    legs_to_build = []
+
     # Проходим по всем элементам плана, начиная со второго
     for i in range(1, len(plan.items)):
         current_item = plan.items[i]
         previous_item = plan.items[i - 1]
 
-        # Получаем координаты предыдущего элемента
-        prev_coords = None
-        if previous_item.get("coords"):
-            prev_coords = {
-                "lon": previous_item["coords"][0],
-                "lat": previous_item["coords"][1],
-            }
-        elif previous_item.get("place_coords_lon"):
-            prev_coords = {
-                "lon": previous_item["place_coords_lon"],
-                "lat": previous_item["place_coords_lat"],
-            }
-
-        # Получаем координаты текущего элемента
-        current_coords = None
-        if current_item.get("coords"):
-            current_coords = {
-                "lon": current_item["coords"][0],
-                "lat": current_item["coords"][1],
-            }
-        elif current_item.get("place_coords_lon"):
-            current_coords = {
-                "lon": current_item["place_coords_lon"],
-                "lat": current_item["place_coords_lat"],
-            }
+        prev_coords = _plan_item_coords(previous_item)
+        current_coords = _plan_item_coords(current_item)
 
         if not prev_coords or not current_coords:
             logger.warning(f"Не удалось получить координаты для элемента {i+1} или {i}")
             continue
 
-        # Строим маршрут между элементами
-        logger.info(
-            f"Строю маршрут от '{previous_item.get('name', 'N/A')}' до '{current_item.get('name', 'N/A')}'"
-        )
-        route_info = await get_route(points=[prev_coords, current_coords])
+        # Если сегмент уже построен между теми же точками, он остается валидным
+        existing_segment = current_item.get("travel_info_to_here") or {}
+        if (
+            existing_segment.get("from_coords") == prev_coords
+            and existing_segment.get("to_coords") == current_coords
+        ):
+            logger.debug(f"Маршрут до элемента {i+1} не изменился, пропускаю пересчет.")
+            continue
 
-        if route_info.get("status") == "success":
-            route_segment = RouteSegment(
-                from_name=previous_item.get("name", "Предыдущий пункт"),
-                to_name=current_item.get("name", "Текущий пункт"),
-                duration_seconds=route_info.get("duration_seconds", 0),
-                distance_meters=route_info.get("distance_meters", 0),
-                from_coords=prev_coords,
-                to_coords=current_coords,
+        legs_to_build.append((i, previous_item, current_item, prev_coords, current_coords))
+
+    # Все отрезки строим параллельно: N последовательных запросов -> одна волна
+    route_results = await asyncio.gather(
+        *[
+            get_route(points=[prev_coords, current_coords])
+            for _, _, _, prev_coords, current_coords in legs_to_build
+        ],
+        return_exceptions=True,
+    )
+
+    for (i, previous_item, current_item, prev_coords, current_coords), route_info in zip(
+        legs_to_build, route_results
+    ):
+        if isinstance(route_info, Exception):
+            logger.warning(
+                f"Не удалось построить маршрут между элементами {i} и {i+1}: {route_info}"
             )
+            continue
+
+        if route_info.get("status") == "success":
+            route_segment: RouteSegmentDict = {
+                "from_name": previous_item.get("name", "Предыдущий пункт"),
+                "to_name": current_item.get("name", "Текущий пункт"),
+                "duration_seconds": int(route_info.get("duration_seconds", 0)),
+                "distance_meters": float(route_info.get("distance_meters", 0)),
+                "from_coords": prev_coords,
+                "to_coords": current_coords,
+            }
 
             # Обновляем информацию о маршруте в текущем элементе
-            current_item["travel_info_to_here"] = route_segment.model_dump()
+            current_item["travel_info_to_here"] = route_segment
             logger.info(
-                f"Маршрут успешно построен: ~{round(route_segment.duration_seconds / 60)} мин, ~{round(route_segment.distance_meters / 1000, 1)} км"
+                f"Маршрут от '{previous_item.get('name', 'N/A')}' до '{current_item.get('name', 'N/A')}' построен: ~{round(route_segment['duration_seconds'] / 60)} мин, ~{round(route_segment['distance_meters'] / 1000, 1)} км"
             )
         else:
             logger.warning(
@@ -417,63 +1024,110 @@ class DecomposedResult(BaseModel):
     decomposed_intents: List[DecomposedIntent]
 
 
-async def classify_intent_node(state: AgentState) -> AgentState:
-    """
-    Узел-Диспетчер. Версия 2.1. Промпт откалиброван для большей точности.
-    """
-    user_query = state.get("user_message")
-    history = state.get("chat_history", [])
-    logger.info("--- УЗЕЛ: classify_intent_node ---")
-    logger.info(f"Определяю намерение для запроса: '{user_query}'")
-
-    llm = get_gigachat_client()
-    structured_llm = llm.with_structured_output(ClassifiedIntent)
-    token_callback = TokenUsageCallbackHandler(node_name="classify_intent")
-    prompt = f"""
-Ты — высокоточный системный диспетчер. Твоя задача — проанализировать запрос пользователя и четко классифицировать его намерение по ОДНОЙ из трех категорий.
-
-### Категории и Ключевые Признаки:
-1.  **PLAN_REQUEST**:
-    *   **Признаки:** В запросе есть упоминания **АКТИВНОСТЕЙ** (кино, парк, погулять, поесть, концерт, стендап), **МЕСТА** (город, адрес) или **ВРЕМЕНИ** (завтра, на выходных, в 15:00).
-    *   **ПРАВИЛО:** Если есть **хотя бы один** из этих признаков — это почти всегда `PLAN_REQUEST`.
-    *   **Примеры:**
-        - "Хочу на фильм и покушать послезавтра в Воронеже" -> PLAN_REQUEST
-        - "Найди стендап в Москве" -> PLAN_REQUEST
-        - "Чем заняться на выходных?" -> PLAN_REQUEST
-        - "Поесть в центре" -> PLAN_REQUEST
-
-2.  **FEEDBACK_ON_PLAN**:
-    *   **Признаки:** Пользователь отвечает на **только что предложенный план**. Ответ содержит прямые указания на изменение плана.
-    *   **Примеры:** "Поменяй ресторан на более дешевый", "А есть сеанс попозже?", "Убери парк", "Да, этот план подходит".
+# Готовые результаты классификации без LLM. Поля заданы кодом, поэтому
+# модели собираются через model_construct один раз, а не на каждый запрос.
+# Экземпляры общие: узлы только читают classified_intent.
+_RULE_CHITCHAT_INTENT = ClassifiedIntent.model_construct(
+    intent=UserIntent.CHITCHAT,
+    reasoning="Типовая фраза для поддержания диалога (правило).",
+)
+_RULE_PLAN_REQUEST_INTENT = ClassifiedIntent.model_construct(
+    intent=UserIntent.PLAN_REQUEST,
+    reasoning="Запрос упоминает активность, место или время (правило).",
+)
+_FALLBACK_INTENT = ClassifiedIntent.model_construct(
+    intent=UserIntent.PLAN_REQUEST,
+    reasoning="Произошла ошибка при классификации, выбран сценарий по умолчанию.",
+)
 
-3.  **CHITCHAT**:
-    *   **Признаки:** Запрос **НЕ содержит** признаков `PLAN_REQUEST` или `FEEDBACK_ON_PLAN`. Это общие фразы.
-    *   **Примеры:** "Привет", "Спасибо", "Что ты умеешь?", "Как дела?", "Ты бот?".
 
-### ЗАДАЧА:
-Проанализируй следующий запрос пользователя и верни JSON с категорией намерения.
-**Запрос:** "{user_query}"
-"""
+def _rule_based_intent(
+    normalized_query: str, has_current_plan: bool
+) -> Optional[ClassifiedIntent]:
+    """
+    Классифицирует очевидные запросы без LLM: приветствия и благодарности -
+    CHITCHAT, активность вместе с указанием времени/места без текущего
+    плана - PLAN_REQUEST. Для неоднозначных запросов возвращает None.
+    """
+    if normalized_query in _CHITCHAT_PHRASES:
+        return _RULE_CHITCHAT_INTENT
+    # При предложенном плане те же слова обычно означают фидбек - решает LLM
+    if (
+        not has_current_plan
+        and _PLAN_ACTIVITY_KEYWORDS_RE.search(normalized_query)
+        and _PLAN_WHEN_WHERE_KEYWORDS_RE.search(normalized_query)
+    ):
+        return _RULE_PLAN_REQUEST_INTENT
+    return None
+
+
+async def _classify_intent(user_query: str, has_current_plan: bool) -> ClassifiedIntent:
+    """Классифицирует намерение пользователя. Промпт откалиброван для большей точности."""
+    normalized_query = _normalize_cache_key(user_query)
+    if (rule_intent := _rule_based_intent(normalized_query, has_current_plan)) is not None:
+        logger.info(f"Намерение определено правилом: {rule_intent.intent}")
+        return rule_intent
+
+    cache_key = (normalized_query, has_current_plan)
+    if (cached_intent := _lru_get(_intent_cache, cache_key)) is not None:
+        logger.info(f"Намерение взято из кэша: {cached_intent.intent}")
+        return cached_intent
+
+    structured_llm = get_structured_llm(ClassifiedIntent)
+    token_callback = get_token_callback("classify_intent")
+    prompt = _INTENT_PROMPT_TEMPLATE.format(user_query=user_query)
 
     try:
         # Проверяем, есть ли в state уже предложенный план. Это важный контекст.
-        if state.get("current_plan"):
+        if has_current_plan:
             # Если план есть, высока вероятность, что это фидбек. Уточняем промпт.
             prompt += "\n**Дополнительный контекст:** Ассистент только что предложил пользователю план. Проанализируй, является ли запрос фидбеком на этот план или сменой темы."
 
-        result = await structured_llm.ainvoke(
-            prompt, config={"callbacks": [token_callback]}
+        result = await bounded_ainvoke(
+            structured_llm, prompt, config={"callbacks": [token_callback]}
         )
-        state["classified_intent"] = result
         logger.info(
             f"Намерение определено как: {result.intent}. Причина: {result.reasoning}"
         )
+        _lru_put(_intent_cache, cache_key, result, _INTENT_CACHE_SIZE)
+        return result
     except Exception as e:
         logger.error(f"Ошибка при классификации намерения: {e}", exc_info=True)
-        state["classified_intent"] = ClassifiedIntent(
-            intent=UserIntent.PLAN_REQUEST,
-            reasoning="Произошла ошибка при классификации, выбран сценарий по умолчанию.",
-        )
+        return _FALLBACK_INTENT
+
+
+async def classify_intent_node(state: AgentState) -> AgentState:
+    """
+    Узел-Диспетчер. Версия 2.2.
+    Если включен ENABLE_SPECULATIVE_EXTRACT, параллельно с классификацией
+    спекулятивно запускает извлечение критериев. Для PLAN_REQUEST готовый
+    результат передается в extract_initial_criteria_node, иначе задача отменяется.
+    """
+    user_query = state.get("user_message")
+    logger.info("--- УЗЕЛ: classify_intent_node ---")
+    logger.info(f"Определяю намерение для запроса: '{user_query}'")
+
+    has_current_plan = bool(state.get("current_plan"))
+    extract_task = None
+    # Для приветствий и благодарностей извлекать критерии бессмысленно, а при
+    # готовом плане реплика почти всегда - отзыв на план (FEEDBACK_ON_PLAN)
+    if (
+        settings.ENABLE_SPECULATIVE_EXTRACT
+        and not has_current_plan
+        and _normalize_cache_key(user_query) not in _CHITCHAT_PHRASES
+    ):
+        extract_task = asyncio.create_task(_extract_criteria(user_query))
+
+    result = await _classify_intent(user_query, has_current_plan)
+    state["classified_intent"] = result
+    state["speculative_extraction"] = None
+
+    if extract_task:
+        if result.intent == UserIntent.PLAN_REQUEST:
+            state["speculative_extraction"] = await extract_task
+        else:
+            extract_task.cancel()
+            logger.info("Спекулятивное извлечение критериев отменено.")
     return state
 
 
@@ -486,23 +1140,12 @@ async def chitchat_node(state: AgentState) -> AgentState:
     logger.info(f"Генерирую ответ на общий вопрос: '{user_query}'")
 
     llm = get_gigachat_client()
-    token_callback = TokenUsageCallbackHandler(node_name="chitchat_node")
-    prompt = f"""
-Ты — дружелюбный и услужливый ассистент по планированию досуга.
-Пользователь написал тебе сообщение, которое не является запросом на составление плана.
-Твоя задача — вежливо и по делу ответить ему.
-
-Ключевые моменты, которые нужно упомянуть в ответе:
-- Ты можешь помочь найти мероприятия (кино, концерты, стендапы), места для прогулок (парки) и отдыха.
-- Ты умеешь составлять из них последовательный план с учетом времени и маршрутов.
-- Предложи пользователю сформулировать свой запрос, например: "Найди мне стендап в Воронеже на этих выходных".
-
-Запрос пользователя: "{user_query}"
-
-Сформируй краткий, дружелюбный и полезный ответ.
-"""
+    token_callback = get_token_callback("chitchat_node")
+    prompt = _CHITCHAT_PROMPT_TEMPLATE.format(user_query=user_query)
     try:
-        response = await llm.ainvoke(prompt, config={"callbacks": [token_callback]})
+        response = await bounded_ainvoke(
+            llm, prompt, config={"callbacks": [token_callback]}
+        )
         ai_response = response.content
     except Exception as e:
         logger.error(f"Ошибка при генерации chitchat-ответа: {e}")
@@ -531,57 +1174,85 @@ class FlatExtraction(BaseModel):
     )
 
 
-async def extract_initial_criteria_node(state: AgentState) -> AgentState:
+async def _extract_criteria_combined(user_query: str) -> ExtractedInitialInfo:
     """
-    Извлекает и классифицирует критерии из запроса пользователя в 2 этапа.
-    Версия 2.2 с супер-надежным извлечением активностей в виде строки.
+    Извлекает критерии и классифицирует активности одним запросом к LLM.
+    Ошибки запроса пробрасываются вызывающему коду.
     """
-    user_query = state.get("user_message")
-    logger.info("--- УЗЕЛ: extract_initial_criteria_node (v2.2, надежный) ---")
-    logger.info(f"Обработка запроса: '{user_query}'")
+    combined_extractor = get_structured_llm(CombinedExtractedInfo)
+    token_callback = get_token_callback("extract_criteria_combined")
+    combined_data = await bounded_ainvoke(
+        combined_extractor,
+        _COMBINED_EXTRACT_PROMPT_TEMPLATE.format(user_query=user_query),
+        config={"callbacks": [token_callback]},
+    )
 
-    llm = get_gigachat_client()
+    ordered_activities = []
+    for act in combined_data.ordered_activities:
+        if act.activity_type == "UNKNOWN" or not act.query_details.strip():
+            logger.warning(
+                f"Активность '{act.query_details}' не распознана ({act.activity_type}) и пропущена."
+            )
+            continue
+        ordered_activities.append(
+            OrderedActivityItem(
+                activity_type=act.activity_type, query_details=act.query_details
+            )
+        )
 
-    # --- ЭТАП 1: Упрощенное извлечение с activities_str для надежности ---
-    try:
-        simple_extractor = llm.with_structured_output(SimplifiedExtractedInfo)
-        token_callback_extract = TokenUsageCallbackHandler(
-            node_name="extract_criteria_step1"
+    final_criteria = ExtractedInitialInfo(
+        city=combined_data.city,
+        dates_description=combined_data.dates_description,
+        ordered_activities=ordered_activities,
+        budget=combined_data.budget,
+        person_count=combined_data.person_count,
+        raw_time_description=combined_data.raw_time_description,
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Критерии извлечены одним запросом: %s",
+            final_criteria.model_dump_json(),
         )
+    return final_criteria
 
-        # ОБНОВЛЕННЫЙ ПРОМПТ: Просим строку, а не список
-        prompt_extract = f"""
-Ты — системный анализатор. Твоя задача — извлечь из запроса пользователя ключевую информацию.
-Извлеки ВСЕ упоминания активностей (дел, занятий) как ОДНУ СТРОКУ, разделенную запятыми.
 
-### Пример 1:
-- Запрос: "Хочу на фильм и покушать еще в парке погулять послезавтра в воронеже"
-- Результат (JSON):
-  {{
-    "city": "Воронеж",
-    "dates_description": "послезавтра",
-    "activities_str": "фильм, покушать, в парке погулять"
-  }}
+async def _extract_criteria(
+    user_query: str,
+) -> Tuple[Optional[ExtractedInitialInfo], Optional[str]]:
+    """
+    Извлекает и классифицирует критерии из запроса пользователя одним
+    совмещенным запросом к LLM. Двухэтапный путь (извлечение + классификация)
+    используется, только если совмещенный запрос завершился ошибкой.
+    Возвращает (критерии, None) или (None, сообщение об ошибке для пользователя).
+    Не трогает state, поэтому может выполняться спекулятивно.
+    """
+    try:
+        final_criteria = await _extract_criteria_combined(user_query)
+    except Exception as e:
+        logger.warning(f"Совмещенное извлечение критериев не удалось: {e}")
+    else:
+        if not final_criteria.ordered_activities:
+            logger.error("Совмещенное извлечение не распознало ни одной активности.")
+            return None, (
+                "Не смог понять, чем вы хотите заняться. Попробуйте переформулировать."
+            )
+        return final_criteria, None
 
-### Пример 2:
-- Запрос: "Найди стендап в Москве на выходных, а потом сходим в бар"
-- Результат (JSON):
-  {{
-    "city": "Москва",
-    "dates_description": "на выходных",
-    "activities_str": "стендап, сходим в бар"
-  }}
+    # --- ЭТАП 1: Упрощенное извлечение с activities_str для надежности ---
+    try:
+        simple_extractor = get_structured_llm(SimplifiedExtractedInfo)
+        token_callback_extract = get_token_callback("extract_criteria_step1")
 
-### ЗАДАЧА:
-Проанализируй следующий запрос пользователя и верни ТОЛЬКО JSON-объект.
-**Запрос:** "{user_query}"
-"""
-        simplified_data = await simple_extractor.ainvoke(
-            prompt_extract, config={"callbacks": [token_callback_extract]}
-        )
-        logger.info(
-            f"Этап 1: Успешно извлечены упрощенные данные: {simplified_data.model_dump_json(indent=2)}"
+        # ОБНОВЛЕННЫЙ ПРОМПТ: Просим строку, а не список
+        prompt_extract = _EXTRACT_PROMPT_TEMPLATE.format(user_query=user_query)
+        simplified_data = await bounded_ainvoke(
+            simple_extractor, prompt_extract, config={"callbacks": [token_callback_extract]}
         )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Этап 1: Успешно извлечены упрощенные данные: %s",
+                simplified_data.model_dump_json(),
+            )
 
         # КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Проверяем новую строку, а не список
         if not simplified_data.activities_str:
@@ -601,48 +1272,15 @@ async def extract_initial_criteria_node(state: AgentState) -> AgentState:
     except Exception as e:
         error_message = f"Ошибка на этапе 1 (извлечение): {e}"
         logger.error(error_message, exc_info=True)
-        state["error"] = (
+        return None, (
             "Не смог понять, чем вы хотите заняться. Попробуйте переформулировать."
         )
-        return state
 
-    # --- ЭТАП 2: Классификация каждой активности (без изменений) ---
+    # --- ЭТАП 2: Параллельная классификация каждой активности ---
     try:
-        activity_classifier = llm.with_structured_output(ActivityClassifier)
-        ordered_activities = []
-
-        # КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Итерируемся по списку, созданному из строки
-        for activity_str in activities_list:
-            token_callback_classify = TokenUsageCallbackHandler(
-                node_name=f"extract_criteria_step2_{activity_str[:10]}"
-            )
-            prompt_classify = f"""
-Твоя задача — классифицировать активность пользователя, выбрав ОДИН наиболее подходящий системный тип.
-### Системные типы и их ключевые слова:
-- **MOVIE**: Кино, фильм, сеанс, кинотеатр.
-- **PARK**: Парк, сквер, погулять на природе, сад, набережная, аллея.
-- **RESTAURANT**: Поесть, покушать, ресторан, кафе, бар, ужин, обед, перекусить, выпить кофе.
-- **CONCERT**: Концерт, музыкальное выступление, опен-эйр.
-- **STAND_UP**: Стендап, комедийное шоу, открытый микрофон.
-- **PERFORMANCE**: Спектакль, театр, балет, опера.
-- **MUSEUM_EXHIBITION**: Музей, выставка, галерея, экспозиция.
-- **UNKNOWN**: Если не подходит ни один из вышеперечисленных.
-### ЗАДАЧА: Классифицируй следующую активность: "{activity_str}"
-"""
-            classified_activity = await activity_classifier.ainvoke(
-                prompt_classify, config={"callbacks": [token_callback_classify]}
-            )
-            logger.info(
-                f"Активность '{activity_str}' классифицирована как {classified_activity.activity_type}"
-            )
-
-            if classified_activity.activity_type != "UNKNOWN":
-                ordered_activities.append(
-                    OrderedActivityItem(
-                        activity_type=classified_activity.activity_type,
-                        query_details=activity_str,
-                    )
-                )
+        ordered_activities = await _classify_activities(
+            activities_list, callback_prefix="extract_criteria_step2"
+        )
 
         if not ordered_activities:
             raise ValueError("Ни одна из извлеченных активностей не была распознана.")
@@ -656,20 +1294,44 @@ async def extract_initial_criteria_node(state: AgentState) -> AgentState:
             raw_time_description=simplified_data.raw_time_description,
         )
 
-        logger.info(
-            f"Этап 2: Успешно собраны финальные критерии: {final_criteria.model_dump_json(indent=2)}"
-        )
-        state["search_criteria"] = final_criteria
-        state["error"] = None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Этап 2: Успешно собраны финальные критерии: %s",
+                final_criteria.model_dump_json(),
+            )
+        return final_criteria, None
 
     except Exception as e:
         error_message = f"Ошибка на этапе 2 (классификация): {e}"
         logger.error(error_message, exc_info=True)
-        state["error"] = (
+        return None, (
             "Возникла проблема при анализе ваших пожеланий. Пожалуйста, попробуйте еще раз."
         )
+
+
+async def extract_initial_criteria_node(state: AgentState) -> AgentState:
+    """
+    Извлекает и классифицирует критерии из запроса пользователя в 2 этапа.
+    Версия 2.3: переиспользует спекулятивный результат из classify_intent_node.
+    """
+    user_query = state.get("user_message")
+    logger.info("--- УЗЕЛ: extract_initial_criteria_node (v2.3, надежный) ---")
+    logger.info(f"Обработка запроса: '{user_query}'")
+
+    speculative_result = state.get("speculative_extraction")
+    state["speculative_extraction"] = None
+    if speculative_result is not None:
+        logger.info("Использую результат спекулятивного извлечения критериев.")
+        final_criteria, error = speculative_result
+    else:
+        final_criteria, error = await _extract_criteria(user_query)
+
+    if error:
+        state["error"] = error
         return state
 
+    state["search_criteria"] = final_criteria
+    state["error"] = None
     return state
 
 
@@ -689,9 +1351,6 @@ async def build_initial_plan_node(state: AgentState) -> AgentState:
         return state
     # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
 
-    # Импортируем PlanBuilder здесь, чтобы избежать циклических импортов
-    from src.agent_core.planner import PlanBuilder
-
     # PlanBuilder сам разберется с состоянием, передаем его целиком
     builder = PlanBuilder(state)
     result = await builder.build()
@@ -715,6 +1374,60 @@ async def build_initial_plan_node(state: AgentState) -> AgentState:
     return state
 
 
+def _validate_candidates(activity_type: str, result_list: List[dict]) -> List[PlanItem]:
+    """
+    Превращает словари инструментов поиска в модели кандидатов.
+    Инструменты уже провалидировали данные и вернули model_dump(), поэтому
+    повторную валидацию не выполняем, а собираем модели через model_construct.
+    """
+    # Для всех типов событий из Афиши по умолчанию используется Event
+    model = _CANDIDATE_MODEL_BY_ACTIVITY.get(activity_type, Event)
+
+    construct = model.model_construct
+    valid_candidates = []
+    append = valid_candidates.append
+    for item_dict in result_list:
+        if not isinstance(item_dict, dict):
+            logger.warning(
+                f"Ошибка валидации кандидата типа '{activity_type}': ожидался dict, получено {str(item_dict)[:200]}..."
+            )
+            continue
+        append(construct(**item_dict))
+    return valid_candidates
+
+
+async def _tagged(tag, coro) -> Tuple[Any, Any]:
+    """
+    Возвращает результат корутины вместе с меткой задачи.
+    Исключение возвращается как результат, чтобы не потерять метку.
+    """
+    try:
+        return tag, await coro
+    except Exception as e:
+        return tag, e
+
+
+def _cancel_started_searches(
+    search_tasks: List[Tuple[str, Any]], tasks: List[asyncio.Task]
+) -> None:
+    """
+    Отменяет незавершенные задачи поиска и закрывает так и не запущенные
+    корутины, чтобы на любом выходе из узла не оставалось запросов к API.
+    """
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+    for _, task in search_tasks:
+        if isinstance(task, asyncio.Task):
+            if not task.done():
+                task.cancel()
+        elif (
+            asyncio.iscoroutine(task)
+            and inspect.getcoroutinestate(task) == inspect.CORO_CREATED
+        ):
+            task.close()
+
+
 async def prepare_and_search_events_node(state: AgentState) -> AgentState:
     """
     Узел-Сборщик. Версия 2.0.
@@ -738,142 +1451,142 @@ async def prepare_and_search_events_node(state: AgentState) -> AgentState:
         state["error"] = error_msg
         return state
 
+    search_tasks = []
+    tasks: List[asyncio.Task] = []
     try:
-        # --- Шаг 1: Определение города и времени (без изменений) ---
-        cities = await fetch_cities()
-        city_info = next(
-            (c for c in cities if c["name"].lower() == criteria.city.lower()), None
-        )
+        # --- Шаг 1: Поиск парков и еды не зависит от даты и id города Афиши,
+        # поэтому запускается сразу, параллельно с определением города и времени ---
+        for activity in criteria.ordered_activities:
+            activity_type = activity.activity_type.upper()
+            query = activity.query_details or ""
+
+            if activity_type == "PARK":
+                logger.info(f"Запускаю поиск парка: query='{query}'")
+                task = asyncio.create_task(
+                    park_search_tool.ainvoke(
+                        {"query": query or "парк", "city": criteria.city}
+                    )
+                )
+                search_tasks.append((activity_type, task))
+
+            elif activity_type == "RESTAURANT":
+                logger.info(f"Запускаю поиск еды: query='{query}'")
+                task = asyncio.create_task(
+                    food_place_search_tool.ainvoke(
+                        {"query": query or "ресторан", "city": criteria.city}
+                    )
+                )
+                search_tasks.append((activity_type, task))
 
+            elif activity_type in _EVENT_ACTIVITY_TYPES:
+                # Задача на поиск события создается после разбора даты
+                search_tasks.append((activity_type, activity))
+
+        # --- Шаг 2: Определение города и времени (независимые запросы, параллельно) ---
+        city_info, parsed_time = await asyncio.gather(
+            find_city_by_name(criteria.city),
+            datetime_parser_tool.ainvoke(
+                {
+                    "natural_language_date": criteria.dates_description,
+                    "natural_language_time_qualifier": criteria.raw_time_description,
+                }
+            ),
+        )
         if not city_info:
             state["error"] = f"Не удалось найти город '{criteria.city}' в базе."
             return state
         city_id, city_name = city_info["id"], city_info["name"]
 
-        parsed_time = await datetime_parser_tool.ainvoke(
-            {
-                "natural_language_date": criteria.dates_description,
-                "natural_language_time_qualifier": criteria.raw_time_description,
-            }
-        )
         if not parsed_time or not parsed_time.get("datetime_iso"):
             state["error"] = (
                 f"Не удалось распознать дату: '{criteria.dates_description}'"
             )
             return state
 
-        state["parsed_dates_iso"] = [parsed_time["datetime_iso"]]
-        state["parsed_end_dates_iso"] = (
-            [parsed_time["end_datetime_iso"]]
-            if parsed_time.get("end_datetime_iso")
-            else []
-        )
+        _store_parsed_dates(state, parsed_time)
 
-        start_date = datetime.fromisoformat(parsed_time["datetime_iso"])
-        end_date = (
-            datetime.fromisoformat(parsed_time["end_datetime_iso"])
-            if parsed_time.get("end_datetime_iso")
-            else start_date.replace(hour=23, minute=59, second=59)
+        start_date = state["parsed_start_dt"]
+        end_date = state["parsed_end_dt"] or start_date.replace(
+            hour=23, minute=59, second=59
         )
 
-        # --- Шаг 2: Формирование очереди задач для всех активностей ---
-        search_tasks = []
-        for activity in criteria.ordered_activities:
-            activity_type = activity.activity_type.upper()
-            query = activity.query_details or ""
+        # --- Дозаполняем задачи на поиск событий Афиши ---
+        for index, (activity_type, activity) in enumerate(search_tasks):
+            if not isinstance(activity, OrderedActivityItem):
+                continue
+            logger.info(
+                f"Добавляю в очередь задачу на поиск события: type='{activity_type}'"
+            )
+            budget_to_use = activity.activity_budget or criteria.budget
+            budget_per_person = (
+                budget_to_use / criteria.person_count
+                if budget_to_use and criteria.person_count
+                else None
+            )
+            task = event_search_tool.ainvoke(
+                {
+                    "city_id": city_id,
+                    "city_name": city_name,
+                    "date_from": start_date,
+                    "date_to": end_date,
+                    "user_creation_type_key": activity_type,
+                    "max_budget_per_person": budget_per_person,
+                }
+            )
+            search_tasks[index] = (activity_type, task)
 
-            if activity_type in [
-                "MOVIE",
-                "CONCERT",
-                "PERFORMANCE",
-                "STAND_UP",
-                "MUSEUM_EXHIBITION",
-            ]:
-                logger.info(
-                    f"Добавляю в очередь задачу на поиск события: type='{activity_type}'"
-                )
-                budget_to_use = activity.activity_budget or criteria.budget
-                budget_per_person = (
-                    budget_to_use / criteria.person_count
-                    if budget_to_use and criteria.person_count
-                    else None
-                )
-                task = event_search_tool.ainvoke(
-                    {
-                        "city_id": city_id,
-                        "city_name": city_name,
-                        "date_from": start_date,
-                        "date_to": end_date,
-                        "user_creation_type_key": activity_type,
-                        "max_budget_per_person": budget_per_person,
-                    }
+        # --- Шаг 3-4: Параллельный поиск и валидация по мере готовности ---
+        # Валидация результатов одного инструмента идет, пока остальные еще
+        # ждут сети. Сбой одного инструмента не отменяет результаты остальных.
+        logger.info(f"Запускаю {len(search_tasks)} задач на поиск...")
+        tasks = [
+            asyncio.create_task(_tagged((index, activity_type), task))
+            for index, (activity_type, task) in enumerate(search_tasks)
+        ]
+        # Результаты раскладываются по индексу задачи, чтобы порядок
+        # кандидатов не зависел от того, какой инструмент ответил первым
+        validated: List[Optional[List[PlanItem]]] = [None] * len(tasks)
+        for next_done in asyncio.as_completed(tasks):
+            (index, activity_type), result_list = await next_done
+            if isinstance(result_list, Exception):
+                logger.warning(
+                    f"Поиск кандидатов типа '{activity_type}' завершился ошибкой: {result_list}"
                 )
-                search_tasks.append((activity_type, task))
-
-            elif activity_type == "PARK":
+                continue
+            if result_list and isinstance(result_list, list):
                 logger.info(
-                    f"Добавляю в очередь задачу на поиск парка: query='{query}'"
-                )
-                task = park_search_tool.ainvoke(
-                    {"query": query or "парк", "city": city_name}
-                )
-                search_tasks.append((activity_type, task))
-
-            # --- НОВЫЙ БЛОК: Логика для поиска еды ---
-            elif activity_type == "RESTAURANT":
-                logger.info(f"Добавляю в очередь задачу на поиск еды: query='{query}'")
-                task = food_place_search_tool.ainvoke(
-                    {"query": query or "ресторан", "city": city_name}
+                    f"Обрабатываю {len(result_list)} кандидатов для типа '{activity_type}'"
                 )
-                search_tasks.append((activity_type, task))
-            # --- КОНЕЦ НОВОГО БЛОКА ---
-
-        # --- Шаг 3: Асинхронное выполнение всех задач ---
-        logger.info(f"Запускаю {len(search_tasks)} задач на поиск...")
-        results = await asyncio.gather(*[t for _, t in search_tasks])
+                validated[index] = _validate_candidates(activity_type, result_list)
         logger.info("Все задачи на поиск завершены.")
 
-        # --- Шаг 4: Сбор и валидация результатов в кэш ---
         date_key = start_date.strftime("%Y-%m-%d")
-        daily_cache = {}
-
-        for (activity_type, _), result_list in zip(search_tasks, results):
-            if result_list and isinstance(result_list, list):
-                if activity_type not in daily_cache:
-                    daily_cache[activity_type] = []
-
-                logger.info(
-                    f"Обрабатываю {len(result_list)} кандидатов для типа '{activity_type}'"
-                )
-                for item_dict in result_list:
-                    try:
-                        if activity_type == "PARK":
-                            daily_cache[activity_type].append(ParkInfo(**item_dict))
-
-                        # --- НОВЫЙ БЛОК: Логика для валидации еды ---
-                        elif activity_type == "RESTAURANT":
-                            daily_cache[activity_type].append(
-                                FoodPlaceInfo(**item_dict)
-                            )
-                        # --- КОНЕЦ НОВОГО БЛОКА ---
-
-                        else:  # Для всех типов событий из Афиши
-                            daily_cache[activity_type].append(Event(**item_dict))
-                    except Exception as e:
-                        logger.warning(
-                            f"Ошибка валидации кандидата типа '{activity_type}': {e} для данных {str(item_dict)[:200]}..."
-                        )
+        # Обычный dict, чтобы чтение по отсутствующему типу не создавало пустых ключей
+        daily_cache: Dict[str, List[PlanItem]] = {}
+        for (activity_type, _), candidates in zip(search_tasks, validated):
+            if not candidates:
+                continue
+            # Первый (часто единственный) список по типу берется как есть, без копирования
+            if (bucket := daily_cache.setdefault(activity_type, candidates)) is not candidates:
+                bucket.extend(candidates)
 
         # Записываем собранных кандидатов в состояние
-        state["cached_candidates"] = {date_key: daily_cache}
-        logger.info(
-            f"Сбор кандидатов завершен. Найдено для даты {date_key}: { {k: len(v) for k, v in daily_cache.items()} }"
-        )
+        state["cached_candidates"] = {date_key: daily_cache}
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Сбор кандидатов завершен. Найдено для даты %s: %s",
+                date_key,
+                {k: len(v) for k, v in daily_cache.items()},
+            )
         state["error"] = None
 
     except Exception as e:
         logger.error(f"Критическая ошибка в узле сбора кандидатов: {e}", exc_info=True)
         state["error"] = "Произошла ошибка при поиске мероприятий."
+    finally:
+        # Ранний выход, ошибка или отмена узла не должны оставлять
+        # работающих задач поиска: после успешного сбора все уже завершены
+        _cancel_started_searches(search_tasks, tasks)
 
     return state
 
@@ -901,6 +1614,21 @@ async def handle_clarification_node(state: AgentState) -> AgentState:
     return state
 
 
+def _set_first_item_travel_info(plan, segment: Optional[RouteSegmentDict]) -> None:
+    """
+    Заменяет первый элемент плана новым словарем с указанным маршрутом от дома
+    (или без него, если segment=None) вместо мутации через del.
+    """
+    if not plan or not plan.items:
+        return
+    new_first = {
+        k: v for k, v in plan.items[0].items() if k != "travel_info_to_here"
+    }
+    if segment is not None:
+        new_first["travel_info_to_here"] = segment
+    plan.items[0] = new_first
+
+
 async def process_start_address_node(state: AgentState) -> AgentState:
     """
     Узел для обработки стартового адреса.
@@ -926,49 +1654,39 @@ async def process_start_address_node(state: AgentState) -> AgentState:
         state["user_start_coordinates"] = None
         # Если у первого элемента был маршрут, его нужно очистить,
         # так как он был рассчитан от "гибкого" старта, а не от дома.
-        if current_plan.items and "travel_info_to_here" in current_plan.items[0]:
-            del current_plan.items[0]["travel_info_to_here"]
+        _set_first_item_travel_info(current_plan, None)
         return state
 
     # Основная логика: геокодирование и расчет маршрута
-    city = state.get("search_criteria").city if state.get("search_criteria") else None
+    criteria = state.get("search_criteria")
+    city = criteria.city if criteria else None
     if not city:
         state["error"] = "Не могу определить город для поиска адреса."
         return state
 
     logger.info(f"Обрабатываю стартовый адрес: '{user_address}' в городе {city}")
-    geo_result = await get_geocoding_details(address=user_address, city=city)
+    geo_task = asyncio.create_task(
+        get_geocoding_details(address=user_address, city=city)
+    )
+    # Пока идет геокодирование, достаем координаты первого мероприятия
+    first_item_dict = current_plan.items[0]
+    first_item_coords = _plan_item_coords(first_item_dict)
+    geo_result = await geo_task
 
     if not geo_result or not geo_result.coords:
         logger.warning(f"Не удалось геокодировать адрес: {user_address}")
         state["user_start_address"] = f"{user_address} (адрес не найден)"
         state["user_start_coordinates"] = None
         # Очищаем маршрут до первого элемента, если он был, т.к. адрес не найден
-        if current_plan.items and "travel_info_to_here" in current_plan.items[0]:
-            del current_plan.items[0]["travel_info_to_here"]
+        _set_first_item_travel_info(current_plan, None)
         return state
 
     # Адрес успешно найден
-    state["user_start_address"] = geo_result.full_address_name_gis or user_address
-    state["user_start_coordinates"] = {
-        "lon": geo_result.coords[0],
-        "lat": geo_result.coords[1],
-    }
-    logger.info(f"Адрес успешно геокодирован: {state['user_start_address']}")
-
-    # Получаем координаты первого мероприятия из плана
-    first_item_dict = current_plan.items[0]
-    first_item_coords = None
-    if first_item_dict.get("coords"):
-        first_item_coords = {
-            "lon": first_item_dict["coords"][0],
-            "lat": first_item_dict["coords"][1],
-        }
-    elif first_item_dict.get("place_coords_lon"):
-        first_item_coords = {
-            "lon": first_item_dict["place_coords_lon"],
-            "lat": first_item_dict["place_coords_lat"],
-        }
+    start_address = geo_result.full_address_name_gis or user_address
+    start_coords = {"lon": geo_result.coords[0], "lat": geo_result.coords[1]}
+    state["user_start_address"] = start_address
+    state["user_start_coordinates"] = start_coords
+    logger.info(f"Адрес успешно геокодирован: {start_address}")
 
     if not first_item_coords:
         logger.warning("Не удалось найти координаты первого мероприятия в плане.")
@@ -977,54 +1695,77 @@ async def process_start_address_node(state: AgentState) -> AgentState:
     # --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ ---
     # Мы не просто создаем новый сегмент, мы ОБНОВЛЯЕМ существующий
     # (или добавляем, если его не было).
-    logger.info("Рассчитываю маршрут от дома до первого мероприятия.")
-    route_info = await get_route(
-        points=[state["user_start_coordinates"], first_item_coords]
+    # Маршрут от дома и маршруты между элементами плана не зависят друг от
+    # друга (пересчет начинается со второго элемента), поэтому строятся разом
+    logger.info("Рассчитываю маршрут от дома и пересчитываю маршруты между элементами плана...")
+    route_info, _ = await asyncio.gather(
+        get_route(points=[start_coords, first_item_coords]),
+        _recalculate_all_route_segments(current_plan, state),
     )
 
     if route_info.get("status") == "success":
-        initial_segment = RouteSegment(
-            from_name=state["user_start_address"],
-            to_name=first_item_dict.get("name", "Первое мероприятие"),
-            duration_seconds=route_info.get("duration_seconds", 0),
-            distance_meters=route_info.get("distance_meters", 0),
-            from_coords=state["user_start_coordinates"],
-            to_coords=first_item_coords,
-        )
+        initial_segment: RouteSegmentDict = {
+            "from_name": start_address,
+            "to_name": first_item_dict.get("name", "Первое мероприятие"),
+            "duration_seconds": int(route_info.get("duration_seconds", 0)),
+            "distance_meters": float(route_info.get("distance_meters", 0)),
+            "from_coords": start_coords,
+            "to_coords": first_item_coords,
+        }
         # Аккуратно заменяем или добавляем информацию о маршруте в первый элемент плана
-        current_plan.items[0]["travel_info_to_here"] = initial_segment.model_dump()
+        _set_first_item_travel_info(current_plan, initial_segment)
         state["current_plan"] = current_plan
         logger.info(
             "Маршрут от дома успешно добавлен/обновлен в первом элементе плана."
         )
-
-        # --- НОВЫЙ КОД: Пересчет всех маршрутов между элементами плана ---
-        logger.info("Пересчитываю маршруты между всеми элементами плана...")
-        await _recalculate_all_route_segments(current_plan, state)
-
     else:
         logger.warning(
             f"Не удалось построить маршрут от дома до первого мероприятия. Ошибка: {route_info.get('message')}"
         )
         # Если маршрут не построился, лучше очистить travel_info, чтобы не было путаницы
-        if "travel_info_to_here" in current_plan.items[0]:
-            del current_plan.items[0]["travel_info_to_here"]
+        _set_first_item_travel_info(current_plan, None)
 
     return state
 
 
 async def router_node(state: AgentState) -> AgentState:
     """
-    Главный узел-оркестратор v8.6.
+    Главный узел-оркестратор v8.7.
     Финальная версия с корректной "памятью" для предотвращения циклов.
+    Диспетчеризация через match по намерению и состоянию плана.
     """
-    logger.info("--- УЗЕЛ: router_node (v8.6) ---")
+    logger.info("--- УЗЕЛ: router_node (v8.7) ---")
 
     # --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Запоминаем, какое действие привело нас сюда ---
     # Это наша "память" о предыдущем шаге.
-    action_that_led_here = state.get("next_action")
+    # Локальная ссылка на state.get: роутер вызывается на каждом шаге графа
+    get = state.get
+    action_that_led_here = get("next_action")
     logger.info(f"Роутер запущен после действия: {action_that_led_here}")
 
+    # Фатальная ошибка PlanBuilder проверяется до очистки "одноразовых" полей:
+    # на этом пути нужно только уйти в PRESENT_RESULTS, не трогая остальное
+    builder_result = get("plan_builder_result")
+    if builder_result and builder_result.failure_reason:
+        logger.error(
+            f"PlanBuilder не смог построить план. Причина: {builder_result.failure_reason}. -> PRESENT_RESULTS"
+        )
+        state["error"] = builder_result.failure_reason
+        state["next_action"] = PossibleActions.PRESENT_RESULTS
+        # Оставшиеся команды относятся к плану, который не удалось построить:
+        # иначе они исполнились бы позже, уже против нового плана
+        if command_queue := get("command_queue"):
+            logger.warning(
+                f"Отбрасываю {len(command_queue)} невыполненных команд из очереди."
+            )
+            command_queue.clear()
+        return state
+
+    # Намерение читаем до очистки "одноразовых" полей, иначе
+    # PLAN_REQUEST и FEEDBACK_ON_PLAN никогда не доходят до роутера.
+    classified_intent = get("classified_intent")
+    intent = classified_intent.intent if classified_intent else None
+
     # Очистка "одноразовых" полей
     state["error"] = None
     state["classified_intent"] = None
@@ -1032,93 +1773,105 @@ async def router_node(state: AgentState) -> AgentState:
     # --- ИЕРАРХИЯ ПРИНЯТИЯ РЕШЕНИЙ ---
 
     # Приоритет 0: Обработка ожидания уточнений по критериям
-    if state.get("is_awaiting_criteria_clarification"):
+    if get("is_awaiting_criteria_clarification"):
         logger.info(
             "Приоритет 0: Обнаружен флаг is_awaiting_criteria_clarification. -> PROCESS_CRITERIA_CLARIFICATION"
         )
         state["next_action"] = PossibleActions.PROCESS_CRITERIA_CLARIFICATION
         return state
 
-    classified_intent = state.get("classified_intent")
-
-    # Приоритет 1: Новый запрос на ПОЛНОЕ перепланирование
-    if classified_intent and classified_intent.intent == UserIntent.PLAN_REQUEST:
-        logger.info(
-            "Приоритет 1: Получен новый PLAN_REQUEST. Полный сброс и переход к извлечению критериев."
-        )
-        # ... (этот блок без изменений)
-        state["search_criteria"] = None
-        state["cached_candidates"] = {}
-        state["current_plan"] = None
-        state["pinned_items"] = {}
-        state["plan_builder_result"] = None
-        state["user_start_address"] = None
-        state["user_start_coordinates"] = None
-        state["is_awaiting_start_address"] = False
-        state["is_awaiting_criteria_clarification"] = False
-        state["missing_criteria_fields"] = []
-        state["last_clarification_question"] = None
-        state["next_action"] = PossibleActions.EXTRACT_CRITERIA
-        return state
+    match intent:
+        # Приоритет 1: Новый запрос на ПОЛНОЕ перепланирование
+        case UserIntent.PLAN_REQUEST:
+            logger.info(
+                "Приоритет 1: Получен новый PLAN_REQUEST. Полный сброс и переход к извлечению критериев."
+            )
+            state.update(
+                _PLAN_REQUEST_RESET,
+                cached_candidates={},
+                pinned_items={},
+                missing_criteria_fields=[],
+                command_queue=deque(),
+            )
+            return state
 
-    # Приоритет 2: Новый ФИДБЕК на существующий план
-    if classified_intent and classified_intent.intent == UserIntent.FEEDBACK_ON_PLAN:
-        logger.info("Приоритет 2: Обнаружен FEEDBACK_ON_PLAN. -> ANALYZE_FEEDBACK")
-        state["next_action"] = PossibleActions.ANALYZE_FEEDBACK
-        return state
+        # Приоритет 2: Новый ФИДБЕК на существующий план
+        case UserIntent.FEEDBACK_ON_PLAN:
+            logger.info("Приоритет 2: Обнаружен FEEDBACK_ON_PLAN. -> ANALYZE_FEEDBACK")
+            state["next_action"] = PossibleActions.ANALYZE_FEEDBACK
+            return state
 
     # Приоритет 3: Обработка ОЧЕРЕДИ команд
-    if command_queue := state.get("command_queue", []):
-        # ... (этот блок без изменений)
+    if command_queue := get("command_queue", []):
         command_type = command_queue[0].command
         logger.info(f"Приоритет 3: Обработка команды '{command_type}' из очереди.")
-        action_map = {
-            "modify": PossibleActions.REFINE_PLAN,
-            "delete": PossibleActions.DELETE_ACTIVITY,
-            "add": PossibleActions.ADD_ACTIVITY,
-            "update_criteria": PossibleActions.SEARCH_EVENTS,
-        }
-        if command_type in action_map:
-            if command_type == "update_criteria":
-                state["cached_candidates"] = {}
-                state["pinned_items"] = {}
-                state["current_plan"] = None
-            state["next_action"] = action_map[command_type]
-        else:
-            state["next_action"] = PossibleActions.PRESENT_RESULTS
+        match _COMMAND_ACTION_MAP.get(command_type):
+            case None:
+                state["next_action"] = PossibleActions.PRESENT_RESULTS
+            case PossibleActions.SEARCH_EVENTS as action:
+                state.update(
+                    cached_candidates={},
+                    pinned_items={},
+                    current_plan=None,
+                    next_action=action,
+                )
+            case action:
+                state["next_action"] = action
         return state
 
-    # Приоритет 4: Проверка на ФАТАЛЬНУЮ ошибку PlanBuilder
-    if builder_result := state.get("plan_builder_result"):
-        # ... (этот блок без изменений)
-        if builder_result.failure_reason:
-            logger.error(
-                f"Приоритет 4: PlanBuilder не смог построить план. Причина: {builder_result.failure_reason}. -> PRESENT_RESULTS"
-            )
-            state["error"] = builder_result.failure_reason
+    # Приоритет 4: Стандартный путь построения/показа плана
+    match (
+        bool(get("search_criteria")),
+        action_that_led_here == PossibleActions.CHECK_CRITERIA,
+        bool(get("cached_candidates")),
+        bool(get("current_plan")),
+    ):
+        case (False, _, _, _):
+            state["next_action"] = PossibleActions.EXTRACT_CRITERIA
+        # --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Используем "память" для разрыва цикла ---
+        case (True, True, _, _):
+            # Если мы пришли сюда сразу после УСПЕШНОЙ проверки, значит,
+            # критерии полны и можно переходить к поиску.
+            logger.info("Критерии только что были успешно проверены. Переходим к поиску.")
+            state["next_action"] = PossibleActions.SEARCH_EVENTS
+        case (True, False, False, _):
+            # Если мы здесь не после проверки, и кэша нет, то отправляем на проверку.
+            state["next_action"] = PossibleActions.CHECK_CRITERIA
+        case (True, False, True, False):
+            state["next_action"] = PossibleActions.BUILD_PLAN
+        case _:
             state["next_action"] = PossibleActions.PRESENT_RESULTS
-            return state
-
-    # Приоритет 5: Стандартный путь построения/показа плана
-    if not state.get("search_criteria"):
-        state["next_action"] = PossibleActions.EXTRACT_CRITERIA
-    # --- КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Используем "память" для разрыва цикла ---
-    elif action_that_led_here == PossibleActions.CHECK_CRITERIA:
-        # Если мы пришли сюда сразу после УСПЕШНОЙ проверки, значит,
-        # критерии полны и можно переходить к поиску.
-        logger.info("Критерии только что были успешно проверены. Переходим к поиску.")
-        state["next_action"] = PossibleActions.SEARCH_EVENTS
-    elif not state.get("cached_candidates"):
-        # Если мы здесь не после проверки, и кэша нет, то отправляем на проверку.
-        state["next_action"] = PossibleActions.CHECK_CRITERIA
-    elif not state.get("current_plan"):
-        state["next_action"] = PossibleActions.BUILD_PLAN
-    else:
-        state["next_action"] = PossibleActions.PRESENT_RESULTS
 
     logger.info(f"Роутер решил: следующее действие -> {state['next_action'].value}")
     return state
 
+async def _present_with_cache(llm, prompt: str) -> str:
+    """
+    Генерирует текст презентации плана, кэшируя его по хэшу промпта.
+    Промпт однозначно задает план, маршрут и формат ответа, поэтому
+    повторный показ того же плана обходится без запроса к LLM.
+    """
+    cache_key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+    entry = _presentation_cache.get(cache_key)
+    if entry is not None:
+        expires_at, cached_text = entry
+        if monotonic() < expires_at:
+            _presentation_cache.move_to_end(cache_key)
+            logger.info("Presenter: Текст презентации взят из кэша.")
+            return cached_text
+        del _presentation_cache[cache_key]
+
+    response_text = (await bounded_ainvoke(llm, prompt)).content
+    if response_text:
+        _lru_put(
+            _presentation_cache,
+            cache_key,
+            (monotonic() + _PRESENTATION_CACHE_TTL_SECONDS, response_text),
+            _PRESENTATION_CACHE_SIZE,
+        )
+    return response_text
+
+
 async def presenter_node(state: AgentState) -> AgentState:
     """
     Представляет результаты пользователю.
@@ -1130,7 +1883,8 @@ async def presenter_node(state: AgentState) -> AgentState:
     error = state.get("error")
     plan_to_show = state.get("current_plan")
     user_start_address = state.get("user_start_address")
-    chat_history = state.get("chat_history", [])
+    chat_history = state.get("chat_history") or ()
+    next_action = state.get("next_action")
     response_text = ""
     llm = get_gigachat_client()
 
@@ -1141,7 +1895,7 @@ async def presenter_node(state: AgentState) -> AgentState:
         # Проверяем, было ли это действие запросом на уточнение.
         # Это предотвратит повторный вывод ответа, если presenter_node
         # вызывается по другой причине.
-        if state.get("next_action") == PossibleActions.ASK_FOR_CRITERIA_CLARIFICATION:
+        if next_action == PossibleActions.ASK_FOR_CRITERIA_CLARIFICATION:
             logger.info("Presenter: Обнаружен готовый уточняющий вопрос. Ничего не генерируем, используем его.")
             # Текст уже добавлен в chat_history в предыдущем узле,
             # поэтому здесь просто выходим, ничего не делая.
@@ -1153,52 +1907,39 @@ async def presenter_node(state: AgentState) -> AgentState:
         response_text = "Я не смог составить для вас план. Давайте попробуем еще раз."
     elif not user_start_address:
         state["is_awaiting_start_address"] = True
-        plan_json = plan_to_show.model_dump_json(indent=2)
-        prompt = f"""Ты — "Голос" ассистента. Представь предварительный план и запроси адрес.
-### План:
-{plan_json}
-### Задача:
-1. Начни с: "Вот что я смог для вас подобрать в качестве предварительного плана:".
-2. Структурированно выведи каждый пункт из `items`. Используй Markdown и эмодзи.
-3. **ПЕРЕД** каждым мероприятием, кроме первого, если есть `travel_info_to_here`, добавь строку "⬇️ Переезд ~XX мин." (вычислив минуты).
-4. **В КОНЦЕ** дословно спроси: "📍 Откуда вы планируете начать ваш маршрут? Укажите адрес или напишите 'пропустить'." """
+        prompt = _PRESENTER_DRAFT_PROMPT_TEMPLATE.format(
+            plan_text=_compact_plan(plan_to_show)
+        )
         try:
-            response_text = (await llm.ainvoke(prompt)).content
+            response_text = await _present_with_cache(llm, prompt)
         except Exception:
             response_text = (
                 "Я составил план, но не могу его описать. Откуда начнем маршрут?"
             )
     else:
+        # Сегменты собраны кодом (RouteSegmentDict или model_dump RouteSegment),
+        # поэтому читаем поля напрямую, без повторной валидации
         route_text_parts = []
         total_travel_seconds = 0
         for item in plan_to_show.items:
-            if travel_info := item.get("travel_info_to_here"):
-                try:
-                    segment = RouteSegment.model_validate(travel_info)
-                    minutes = round(segment.duration_seconds / 60)
-                    km = round(segment.distance_meters / 1000, 1)
-                    route_text_parts.append(
-                        f"От «{segment.from_name}» до «{segment.to_name}»: ~{minutes} мин, ~{km} км"
-                    )
-                    total_travel_seconds += segment.duration_seconds
-                except Exception:
-                    continue
+            segment = item.get("travel_info_to_here")
+            if not segment:
+                continue
+            duration_seconds = segment.get("duration_seconds") or 0
+            distance_meters = segment.get("distance_meters") or 0
+            route_text_parts.append(
+                f"От «{segment.get('from_name')}» до «{segment.get('to_name')}»: "
+                f"~{round(duration_seconds / 60)} мин, ~{round(distance_meters / 1000, 1)} км"
+            )
+            total_travel_seconds += duration_seconds
         total_travel_minutes = round(total_travel_seconds / 60)
-        plan_json = plan_to_show.model_dump_json(indent=2)
-        prompt = f"""Ты — "Голос" ассистента. Представь итоговый план с маршрутом.
-### План:
-{plan_json}
-### Маршрут:
-{chr(10).join(route_text_parts)}
-### Общее время в пути: {total_travel_minutes} минут.
-### Задача:
-1. Начни с: "Вот ваш итоговый план:".
-2. Красиво выведи пункты из `items`.
-3. Добавь заголовок "➡️ Маршрут:" и выведи под ним собранный маршрут.
-4. Добавь строку "🚗 Общее время в пути: ~{total_travel_minutes} мин".
-5. Заверши фразой: "План окончательный. Если захотите что-то изменить или начать новый поиск — просто напишите! 😊" """
+        prompt = _PRESENTER_FINAL_PROMPT_TEMPLATE.format(
+            plan_text=_compact_plan(plan_to_show),
+            route_text="\n".join(route_text_parts),
+            total_travel_minutes=total_travel_minutes,
+        )
         try:
-            response_text = (await llm.ainvoke(prompt)).content
+            response_text = await _present_with_cache(llm, prompt)
             state["plan_presented"] = True
         except Exception:
             response_text = "Я составил итоговый план, но не могу его описать."
@@ -1210,6 +1951,79 @@ async def presenter_node(state: AgentState) -> AgentState:
     return state
 
 
+def _parse_commands(response_text: str) -> List[SemanticConstraint]:
+    """
+    Разбирает блок <commands> из ответа LLM в семантическое ядро.
+    Чистая функция без доступа к состоянию: ответ ограничен max_tokens
+    клиента, поэтому разбор занимает микросекунды и выполняется прямо в цикле событий.
+    """
+    command_text_match = _COMMANDS_BLOCK_RE.search(response_text)
+    if not command_text_match:
+        logger.warning("Тег <commands> не найден в ответе LLM.")
+        return []
+
+    command_text = command_text_match.group(1).strip()
+
+    semantic_intents = []
+    for line in command_text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if '"' in line:
+            # Значения в кавычках могут содержать ";": такие строки
+            # токенизирует csv.reader
+            row = next(csv.reader((line,), delimiter=";", skipinitialspace=True), [])
+        elif line.count(";") != 5:
+            # Без кавычек число полей известно до разбиения строки
+            logger.warning(f"Пропуск некорректной строки команды: '{line}'")
+            continue
+        else:
+            row = line.split(";")
+        fields = [field.strip() for field in row]
+        if not any(fields):
+            continue
+        # lower() нужен только полям длины 4 - кандидатам на 'None'
+        parts = [
+            None if len(field) == 4 and field.lower() == "none" else field
+            for field in fields
+        ]
+        if len(parts) != 6:
+            logger.warning(f"Пропуск некорректной строки команды: '{';'.join(row)}'")
+            continue
+
+        command_type, target, attribute, op, value_str, value_num_unit = parts
+        # Поля из закрытого словаря интернируются: дальнейшие сравнения с
+        # литералами и поиск в словарях диспетчеризации идут по указателю
+        if command_type:
+            command_type = sys.intern(command_type)
+        if target:
+            target = sys.intern(target)
+        if attribute:
+            attribute = sys.intern(attribute)
+        if op:
+            op = sys.intern(op)
+
+        value_num, value_unit = None, None
+        if value_num_unit:
+            # Число и единица измерения извлекаются за один проход
+            if num_unit_match := _NUM_UNIT_RE.search(value_num_unit):
+                value_num = float(num_unit_match["num"])
+                value_unit = num_unit_match["unit"]
+
+        semantic_intents.append(
+            SemanticConstraint(
+                command_type=command_type,
+                target=target,
+                attribute=attribute,
+                operator=op,
+                value_str=value_str,
+                value_num=value_num,
+                value_unit=value_unit,
+            )
+        )
+    return semantic_intents
+
+
 # в файле nodes.py
 async def analyze_feedback_node(state: AgentState) -> AgentState:
     """
@@ -1223,11 +2037,10 @@ async def analyze_feedback_node(state: AgentState) -> AgentState:
     user_query = state.get("user_message")
     current_plan = state.get("current_plan")
 
-    # Подготовка контекста (этот блок вы заполняете своим кодом)
+    # Подготовка контекста: план передается компактной таблицей, а не JSON
     simplified_plan_json = "План еще не составлен."
     if current_plan and current_plan.items:
-        # Ваша логика формирования simplified_plan_json остается здесь
-        pass
+        simplified_plan_json = _compact_plan(current_plan)
 
     llm = get_gigachat_client()
     # Нам больше не нужен structured_llm, так как мы работаем с сырым текстом
@@ -1236,52 +2049,35 @@ async def analyze_feedback_node(state: AgentState) -> AgentState:
     logger.info("Шаг 1: Запрос на рассуждение и текстовую разметку.")
 
     # Новый, самый надежный промпт
-    prompt = f"""
-Ты — высокоточный системный аналитик. Твоя задача - проанализировать запрос пользователя на изменение плана, сначала пошагово рассуждая, а затем выдав четкие команды в специальном формате.
-
-### Контекст:
-- **Предложенный план:** {simplified_plan_json}
-- **Запрос пользователя:** "{user_query}"
-
-### ЗАДАЧА:
-Выполни два действия в указанном порядке:
-1.  **Внутри тега `<reasoning>`:** Напиши свои пошаговые рассуждения. Определи, сколько намерений у пользователя и что он хочет сделать с каждым элементом.
-2.  **Внутри тега `<commands>`:** Для каждого намерения напиши ОДНУ команду на новой строке в строго заданном формате с 6 полями, разделенными точкой с запятой. Используй 'None' для пустых полей.
-
-### Формат команды:
-`command_type;target;attribute;operator;value_str;value_num_unit`
-(value_num_unit - это число и единица измерения через пробел, например '2 часа' или '1500 рублей')
-
-### СЛОВАРЬ ТЕРМИНОВ:
-- **command_type**: `modify`, `delete`, `add`, `update_criteria`, `chitchat`.
-- **target**: `MOVIE`, `RESTAURANT`, `PARK`, `date`, `city`.
-- **attribute**: `start_time`, `price`, `rating`, `date`, `city`, `name`.
-- **operator**: `GREATER_THAN`, `LESS_THAN`, `NOT_EQUALS`, `MIN`, `MAX`.
-
-### ПРИМЕР:
-- **Запрос:** "Фильм слишком поздний, давай на часик пораньше. И ресторан найди подешевле, до 1500 рублей, а парк убери. И давай все в Казани."
-- **Твой ответ:**
-<reasoning>
-Пользователь выразил четыре намерения.
-1. Фильм: "на часик пораньше" - это изменение времени в меньшую сторону (modify, LESS_THAN).
-2. Ресторан: "подешевле, до 1500" - это изменение цены в меньшую сторону (modify, LESS_THAN).
-3. Парк: "убери" - это удаление (delete).
-4. Глобальное изменение: "в Казани" - это смена города (update_criteria), что является приоритетной командой.
-</reasoning>
-<commands>
-modify;MOVIE;start_time;LESS_THAN;None;1 час
-modify;RESTAURANT;price;LESS_THAN;None;1500 рублей
-delete;PARK;None;None;None;None
-update_criteria;city;city;None;Казань;None
-</commands>
-
-ЗАДАЧА: Проанализируй запрос и сгенерируй ответ в указанном формате.
-"""
+    prompt = "".join(
+        (
+            _FEEDBACK_PROMPT_HEAD,
+            simplified_plan_json,
+            _FEEDBACK_PROMPT_MID,
+            user_query,
+            _FEEDBACK_PROMPT_TAIL,
+        )
+    )
 
+    # Одинаковые правки ("убери парк") к одинаковому контексту плана дают
+    # одинаковую разметку, поэтому ответ LLM кэшируется по точному ключу
+    cache_key = (_normalize_cache_key(user_query), simplified_plan_json)
     try:
-        response_text = (await llm.ainvoke(prompt)).content
-        logger.info(f"Получен ответ от LLM для разметки:\n---\n{response_text}\n---")
-        logger.debug(f"Получен сырой ответ от LLM:\n{response_text}")
+        if (response_text := _lru_get(_feedback_markup_cache, cache_key)) is not None:
+            logger.info("Разметка команд взята из кэша.")
+        else:
+            # Все нужное лежит в блоке <commands>: как только он закрыт,
+            # остаток генерации не ждем
+            response_text = await bounded_astream_until(llm, "</commands>", prompt)
+            logger.info(f"Получен ответ от LLM для разметки:\n---\n{response_text}\n---")
+            # Кэшируем только ответы с разметкой, иначе повторный запрос ее не получит
+            if _COMMANDS_BLOCK_RE.search(response_text):
+                _lru_put(
+                    _feedback_markup_cache,
+                    cache_key,
+                    response_text,
+                    _FEEDBACK_MARKUP_CACHE_SIZE,
+                )
     except Exception as e:
         logger.error(f"Критическая ошибка при вызове LLM: {e}", exc_info=True)
         state["error"] = "Не удалось получить ответ от языковой модели."
@@ -1289,64 +2085,24 @@ update_criteria;city;city;None;Казань;None
 
     # === ШАГ 2: PYTHON-ПАРСЕР РАЗМЕТКИ ===
     logger.info("Шаг 2: Парсинг текстовой разметки.")
-    all_semantic_intents = []
     try:
-        # Используем re.DOTALL, чтобы . соответствовал и символу новой строки
-        command_text_match = re.search(
-            r"<commands>(.*?)</commands>", response_text, re.DOTALL
-        )
-        if not command_text_match:
-            logger.warning("Тег <commands> не найден в ответе LLM.")
-        else:
-            command_text = command_text_match.group(1).strip()
-            lines = [line.strip() for line in command_text.split("\n") if line.strip()]
-
-            for line in lines:
-                parts = [
-                    p.strip() if p.strip().lower() != "none" else None
-                    for p in line.split(";")
-                ]
-                if len(parts) != 6:
-                    logger.warning(f"Пропуск некорректной строки команды: '{line}'")
-                    continue
-
-                command_type, target, attribute, operator, value_str, value_num_unit = (
-                    parts
-                )
-
-                value_num, value_unit = None, None
-                if value_num_unit:
-                    num_match = re.search(r"[\d.]+", value_num_unit)
-                    unit_match = re.search(r"[а-яА-Яa-zA-Z]+", value_num_unit)
-                    if num_match:
-                        value_num = float(num_match.group(0))
-                    if unit_match:
-                        value_unit = unit_match.group(0)
-
-                all_semantic_intents.append(
-                    SemanticConstraint(
-                        command_type=command_type,
-                        target=target,
-                        attribute=attribute,
-                        operator=operator,
-                        value_str=value_str,
-                        value_num=value_num,
-                        value_unit=value_unit,
-                    )
-                )
+        all_semantic_intents = _parse_commands(response_text)
     except Exception as e:
         logger.error(f"Ошибка на Шаге 2 (Парсинг): {e}", exc_info=True)
         state["error"] = "Не удалось разобрать внутреннюю структуру ответа."
         return state
 
-    logger.debug(
-        f"Итоговое семантическое ядро: {[i.model_dump() for i in all_semantic_intents]}"
-    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Итоговое семантическое ядро: %s",
+            [i.model_dump() for i in all_semantic_intents],
+        )
 
     # === ШАГ 3: ПЕРЕДАЧА В COMMAND PROCESSOR (без изменений) ===
     logger.info("Шаг 3: Передача семантического ядра в CommandProcessor.")
     processor = CommandProcessor(state, all_semantic_intents)
-    state["command_queue"] = processor.process()
+    # deque: узлы-исполнители забирают команды с головы за O(1)
+    state["command_queue"] = deque(processor.process())
     state["error"] = None
     logger.info(
         f"CommandProcessor сформировал {len(state['command_queue'])} исполняемых команд."
@@ -1355,41 +2111,106 @@ update_criteria;city;city;None;Казань;None
     return state
 
 
+def _pop_following_commands(
+    command_queue: Optional[deque], command_type: str, required_field: str
+) -> List[ChangeRequest]:
+    """
+    Забирает с головы очереди идущие подряд команды типа command_type
+    с заполненным полем required_field. Узел-исполнитель выполняет их
+    вместе с текущей командой, без лишних проходов через роутер.
+    """
+    commands = []
+    while command_queue:
+        head = command_queue[0]
+        if head.command != command_type or not getattr(head, required_field):
+            break
+        commands.append(command_queue.popleft())
+    return commands
+
+
+def _remove_activities(criteria: ExtractedInitialInfo, target_types: set) -> set:
+    """
+    Удаляет из criteria.ordered_activities все активности с типом из target_types.
+    Список обрабатывается за один проход на месте, без создания нового:
+    префикс до первого совпадения не перезаписывается, а если совпадений
+    нет, список не изменяется вовсе. Проверка типа - поиск в множестве,
+    поэтому несколько удалений стоят одного прохода.
+    Возвращает множество реально удаленных типов.
+    """
+    activities = criteria.ordered_activities
+    if not activities or not target_types:
+        return set()
+    first = next(
+        (i for i, act in enumerate(activities) if act.activity_type in target_types),
+        None,
+    )
+    if first is None:
+        return set()
+    removed = {activities[first].activity_type}
+    write = first
+    for read in range(first + 1, len(activities)):
+        act = activities[read]
+        if act.activity_type in target_types:
+            removed.add(act.activity_type)
+        else:
+            activities[write] = act
+            write += 1
+    del activities[write:]
+    return removed
+
+
+def _remove_activity(criteria: ExtractedInitialInfo, target_type: str) -> bool:
+    """
+    Удаляет из criteria.ordered_activities все активности типа target_type.
+    Возвращает True, если удаление было.
+    """
+    return bool(_remove_activities(criteria, {target_type}))
+
+
 async def delete_activity_node(state: AgentState) -> AgentState:
     """
-    Узел-Исполнитель для команды 'delete' v2.0.
+    Узел-Исполнитель для команды 'delete' v2.1.
     Удаляет активность из search_criteria и pinned_items.
+    Идущие подряд команды 'delete' выполняются за один проход по списку дел.
     """
+    command_queue = state.get("command_queue")
     command: Optional[ChangeRequest] = (
-        state["command_queue"].pop(0) if state.get("command_queue") else None
+        command_queue.popleft() if command_queue else None
     )
 
-    logger.info(
-        f"--- УЗЕЛ: delete_activity_node ---. Команда: {command.model_dump_json(indent=2)}"
-    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "--- УЗЕЛ: delete_activity_node ---. Команда: %s",
+            command.model_dump_json() if command else "None",
+        )
 
     if not command or command.command != "delete" or not command.target:
         logger.warning("Некорректная или отсутствующая команда 'delete'.")
         return state
 
-    target_type = command.target
-    criteria = state.get("search_criteria")
+    # Забираем из очереди все следующие подряд удаления: каждое из них иначе
+    # стоило бы отдельного прохода графа и отдельного скана списка дел
+    target_types = [command.target]
+    target_types.extend(
+        c.target for c in _pop_following_commands(command_queue, "delete", "target")
+    )
+    if len(target_types) > 1:
+        logger.info(f"Объединяю {len(target_types)} команд 'delete' в один шаг.")
 
+    criteria = state.get("search_criteria")
     if criteria and criteria.ordered_activities:
-        initial_count = len(criteria.ordered_activities)
-        criteria.ordered_activities = [
-            act
-            for act in criteria.ordered_activities
-            if act.activity_type != target_type
-        ]
-        if len(criteria.ordered_activities) < initial_count:
-            logger.info(f"Активность '{target_type}' удалена из search_criteria.")
-        else:
-            logger.warning(f"Активность '{target_type}' не найдена в search_criteria.")
+        removed = _remove_activities(criteria, set(target_types))
+        for target_type in target_types:
+            if target_type in removed:
+                logger.info(f"Активность '{target_type}' удалена из search_criteria.")
+            else:
+                logger.warning(f"Активность '{target_type}' не найдена в search_criteria.")
 
-    if target_type in state.get("pinned_items", {}):
-        del state["pinned_items"][target_type]
-        logger.info(f"Элемент '{target_type}' откреплен (unpinned).")
+    pinned_items = state.get("pinned_items")
+    if pinned_items:
+        for target_type in target_types:
+            if pinned_items.pop(target_type, None) is not None:
+                logger.info(f"Элемент '{target_type}' откреплен (unpinned).")
 
     # План больше не сбрасывается здесь. BUILD_PLAN будет вызван следующим.
     logger.info("Узел delete_activity_node завершил работу. Переход к BUILD_PLAN.")
@@ -1402,13 +2223,16 @@ async def refine_plan_node(state: AgentState) -> AgentState:
     Исправлена логика получения команды и добавлена проверка на пустой результат.
     """
     # --- КЛЮЧЕВОЕ ИСПРАВЛЕНИЕ: Берем команду из очереди, а не из last_structured_command ---
+    command_queue = state.get("command_queue")
     command: Optional[ChangeRequest] = (
-        state["command_queue"].pop(0) if state.get("command_queue") else None
+        command_queue.popleft() if command_queue else None
     )
 
-    logger.info(
-        f"--- УЗЕЛ: refine_plan_node ---. Команда: {command.model_dump_json(indent=2) if command else 'None'}"
-    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "--- УЗЕЛ: refine_plan_node ---. Команда: %s",
+            command.model_dump_json() if command else "None",
+        )
 
     if not command or command.command != "modify":
         logger.warning("Некорректная или отсутствующая команда 'modify'.")
@@ -1422,14 +2246,20 @@ async def refine_plan_node(state: AgentState) -> AgentState:
         logger.warning("Пропуск неполной команды 'modify'.")
         return state
 
-    date_key = next(iter(state.get("cached_candidates", {})), None)
+    cached_candidates = state.get("cached_candidates") or _EMPTY_MAP
+    date_key = next(iter(cached_candidates), None)
     if not date_key:
         state["error"] = "Кэш кандидатов пуст, не могу выполнить изменение."
         logger.error(state["error"])
         return state
+    # Кандидаты на выбранную дату, по типам активностей
+    daily_candidates = cached_candidates[date_key]
 
+    # Сортировочные ограничения сохраняются как предпочтение,
+    # фильтрующие применяются к кандидатам все сразу, за один проход
+    filter_constraints = []
     for constr in constraints:
-        if constr.operator in ["MIN", "MAX"]:
+        if constr.operator in _SORT_OPERATORS:
             logger.info(
                 f"Создание инструкции по сортировке: {constr.operator} для '{target_type}' по '{constr.attribute}'"
             )
@@ -1438,23 +2268,34 @@ async def refine_plan_node(state: AgentState) -> AgentState:
                 "attribute": constr.attribute,
                 "order": constr.operator,
             }
-            continue
+        else:
+            filter_constraints.append(constr)
 
-        all_candidates = state["cached_candidates"][date_key].get(target_type, [])
+    if filter_constraints:
+        all_candidates = daily_candidates.get(target_type, [])
         logger.info(
-            f"Фильтрация {len(all_candidates)} кандидатов для '{target_type}' по '{constr.attribute} {constr.operator} {constr.value}'"
+            f"Фильтрация {len(all_candidates)} кандидатов для '{target_type}' по "
+            + ", ".join(
+                f"'{c.attribute} {c.operator} {c.value}'" for c in filter_constraints
+            )
         )
 
         try:
-            precise_filtered = _apply_constraint(all_candidates, constr)
-            filtered_candidates = precise_filtered
+            expanded = False
+            if any(c.attribute == "start_time" for c in filter_constraints):
+                # Точная и расширенная на ±15 минут фильтрация за один проход;
+                # расширенный результат берется только при пустом точном
+                filtered_candidates, expanded = _apply_constraints_with_expansion(
+                    all_candidates, filter_constraints, expansion_minutes=15
+                )
+            else:
+                filtered_candidates = _apply_constraints(
+                    all_candidates, filter_constraints
+                )
 
-            if not precise_filtered and constr.attribute == "start_time":
+            if expanded:
                 logger.info(
-                    "Точных совпадений по времени нет, расширяю диапазон поиска на ±15 минут."
-                )
-                filtered_candidates = _apply_constraint(
-                    all_candidates, constr, expansion_minutes=15
+                    "Точных совпадений по времени нет, диапазон поиска расширен на ±15 минут."
                 )
                 if filtered_candidates:
                     state["plan_warnings"] = (state.get("plan_warnings") or []) + [
@@ -1470,97 +2311,127 @@ async def refine_plan_node(state: AgentState) -> AgentState:
                     f"Не удалось найти вариантов для '{target_type}' по вашим новым критериям. Эта активность удалена из плана."
                 ]
                 criteria = state.get("search_criteria")
-                if criteria and criteria.ordered_activities:
-                    criteria.ordered_activities = [
-                        act
-                        for act in criteria.ordered_activities
-                        if act.activity_type != target_type
-                    ]
+                if criteria and _remove_activity(criteria, target_type):
                     logger.info(
                         f"Активность '{target_type}' удалена из списка дел из-за отсутствия кандидатов."
                     )
 
-            state["cached_candidates"][date_key][target_type] = filtered_candidates
+            daily_candidates[target_type] = filtered_candidates
         except Exception as e:
             state["error"] = "Ошибка при поиске по новым критериям."
             return state
 
-    if target_type in state.get("pinned_items", {}):
-        del state["pinned_items"][target_type]
+    pinned_items = state.get("pinned_items")
+    if pinned_items and pinned_items.pop(target_type, None) is not None:
         logger.info(f"Элемент '{target_type}' откреплен.")
 
     logger.info("Узел refine_plan_node завершил работу. Переход к BUILD_PLAN.")
     return state
 
 
+async def _search_new_activity(
+    new_activity: OrderedActivityItem, city: str
+) -> List[PlanItem]:
+    """
+    Ищет кандидатов для добавляемой активности всеми подходящими инструментами.
+    Независимые инструменты опрашиваются параллельно.
+    """
+    activity_type = new_activity.activity_type
+    query = new_activity.query_details
+    # TODO: Добавить поддержку всех типов активностей, включая Афишу
+    # TODO: Вынести логику поиска в отдельный инструмент/сервис
+    applicable_tools = _ADD_ACTIVITY_SEARCH_TOOLS.get(activity_type)
+    if not applicable_tools:
+        logger.warning(
+            f"Поиск для типа '{activity_type}' пока не реализован в add_activity_node."
+        )
+        return []
+
+    logger.info(
+        f"Ищу кандидатов для новой активности '{activity_type}' с запросом '{query}'"
+    )
+    results = await asyncio.gather(
+        *[tool.ainvoke({"query": query, "city": city}) for tool in applicable_tools],
+        return_exceptions=True,
+    )
+    candidates = []
+    for result_list in results:
+        if isinstance(result_list, Exception):
+            logger.warning(
+                f"Поиск кандидатов для '{activity_type}' завершился ошибкой: {result_list}"
+            )
+        elif result_list and isinstance(result_list, list):
+            candidates.extend(_validate_candidates(activity_type, result_list))
+    return candidates
+
+
 async def add_activity_node(state: AgentState) -> AgentState:
     """
     Узел-Исполнитель для команды 'add'.
     Ищет кандидатов для новой активности и добавляет их в кэш и критерии.
+    Идущие подряд команды 'add' из очереди исполняются за один раз:
+    поиск для всех новых активностей выполняется параллельно.
     """
     logger.info("--- УЗЕЛ: add_activity_node ---")
+    command_queue = state.get("command_queue")
     command: Optional[ChangeRequest] = (
-        state["command_queue"].pop(0) if state.get("command_queue") else None
+        command_queue.popleft() if command_queue else None
     )
 
     if not command or command.command != "add" or not command.new_activity:
         logger.warning("add_activity_node: нет команды 'add' для исполнения.")
         return state
 
-    new_activity = command.new_activity
-    activity_type = new_activity.activity_type
-    query = new_activity.query_details
     criteria = state.get("search_criteria")
-
-    if not criteria or not criteria.city or not state.get("parsed_dates_iso"):
+    city = criteria.city if criteria else None
+    parsed_dates_iso = state.get("parsed_dates_iso")
+    if not city or not parsed_dates_iso:
         state["error"] = (
             "Недостаточно контекста (город/дата) для добавления активности."
         )
         return state
 
-    logger.info(
-        f"Ищу кандидатов для новой активности '{activity_type}' с запросом '{query}'"
+    new_activities = [command.new_activity]
+    new_activities.extend(
+        c.new_activity
+        for c in _pop_following_commands(command_queue, "add", "new_activity")
     )
+    if len(new_activities) > 1:
+        logger.info(f"Объединяю {len(new_activities)} команд 'add' в один шаг.")
 
     # --- Логика поиска (упрощенная версия prepare_and_search_events_node) ---
     try:
-        # TODO: Добавить поддержку всех типов активностей, включая Афишу
-        # TODO: Вынести логику поиска в отдельный инструмент/сервис
-        if activity_type in ["PARK", "RESTAURANT"]:
-            tool = (
-                park_search_tool if activity_type == "PARK" else food_place_search_tool
-            )
-            candidates = await tool.ainvoke({"query": query, "city": criteria.city})
+        results = await asyncio.gather(
+            *[
+                _search_new_activity(new_activity, city)
+                for new_activity in new_activities
+            ]
+        )
 
+        # ISO-строка начинается с даты в формате YYYY-MM-DD
+        date_key = parsed_dates_iso[0][:10]
+        cached_candidates = state["cached_candidates"]
+        for new_activity, candidates in zip(new_activities, results):
+            activity_type = new_activity.activity_type
             if candidates:
-                date_key = datetime.fromisoformat(
-                    state["parsed_dates_iso"][0]
-                ).strftime("%Y-%m-%d")
-                if date_key not in state["cached_candidates"]:
-                    state["cached_candidates"][date_key] = {}
-                if activity_type not in state["cached_candidates"][date_key]:
-                    state["cached_candidates"][date_key][activity_type] = []
-
-                state["cached_candidates"][date_key][activity_type].extend(candidates)
+                daily_candidates = cached_candidates.setdefault(date_key, {})
+                daily_candidates.setdefault(activity_type, []).extend(candidates)
                 logger.info(
                     f"Добавлено {len(candidates)} кандидатов для '{activity_type}' в кэш."
                 )
-        else:
-            logger.warning(
-                f"Поиск для типа '{activity_type}' пока не реализован в add_activity_node."
-            )
 
-        # Добавляем новую активность в список дел
-        if criteria.ordered_activities:
-            # TODO: Реализовать вставку в корректную позицию (до/после)
-            criteria.ordered_activities.append(new_activity)
-            logger.info(f"Активность '{activity_type}' добавлена в search_criteria.")
+            # Добавляем новую активность в список дел
+            if criteria.ordered_activities:
+                # TODO: Реализовать вставку в корректную позицию (до/после)
+                criteria.ordered_activities.append(new_activity)
+                logger.info(f"Активность '{activity_type}' добавлена в search_criteria.")
 
     except Exception as e:
         logger.error(
             f"Ошибка при поиске кандидатов для новой активности: {e}", exc_info=True
         )
-        state["error"] = f"Не удалось найти варианты для '{query}'."
+        queries = ", ".join(f"'{a.query_details}'" for a in new_activities)
+        state["error"] = f"Не удалось найти варианты для {queries}."
 
     state["current_plan"] = None
     state["plan_builder_result"] = None
@@ -1569,115 +2440,246 @@ async def add_activity_node(state: AgentState) -> AgentState:
     return state
 
 
-def _apply_constraint(
-    candidates: List[PlanItem], constr: Constraint, expansion_minutes: int = 0
-) -> List[PlanItem]:
+@lru_cache(maxsize=4096)
+def _parse_avg_bill(avg_bill_str: str) -> Optional[float]:
     """
-    Применяет одно семантическое ограничение к списку кандидатов.
-    Версия 2.1: Универсальная, работает с разными типами объектов (Event, FoodPlaceInfo).
-    """
-    new_filtered_list = []
-
-    # --- НАЧАЛО ИСПРАВЛЕНИЯ ---
-    import re
-    from src.schemas.data_schemas import (
-        Event,
-        FoodPlaceInfo,
-        ParkInfo,
-    )  # Добавляем импорты
-    from datetime import datetime, timedelta  # Добавляем импорты
-
-    # Вспомогательная функция для безопасного извлечения числового значения цены
-    def get_price_from_candidate(candidate: PlanItem) -> Optional[float]:
-        if isinstance(candidate, Event) and candidate.min_price is not None:
-            return float(candidate.min_price)
-        if isinstance(candidate, FoodPlaceInfo) and candidate.avg_bill_str:
-            # Извлекаем первое число из строки типа "1000–1500 ₽" или "1200 ₽"
-            match = re.search(r"\d+", candidate.avg_bill_str.replace(" ", ""))
-            if match:
-                return float(match.group(0))
-        return None
-
-    # Сопоставляем семантику с реальными атрибутами или функциями
-    attr_map = {
-        "start_time": "start_time_naive_event_tz",
-        "rating": "rating",
-        "name": "name",
-        # Для цены теперь используем нашу новую функцию
-        "price": get_price_from_candidate,
-    }
-
-    model_attribute_or_getter = attr_map.get(constr.attribute)
-    if not model_attribute_or_getter:
+    Извлекает первое число из строки типа "1000–1500 ₽" или "1200 ₽".
+    Кэшируется: строки среднего чека повторяются у одних и тех же заведений
+    при каждой фильтрации, и регулярное выражение - самая дорогая часть
+    извлечения столбца цен.
+    """
+    match = _PRICE_RE.search(avg_bill_str)
+    if match:
+        return float("".join(match.group(0).split()))
+    return None
+
+
+def _get_candidate_price(candidate: PlanItem) -> Optional[float]:
+    """Безопасно извлекает числовое значение цены кандидата."""
+    if isinstance(candidate, Event) and candidate.min_price is not None:
+        return float(candidate.min_price)
+    if isinstance(candidate, FoodPlaceInfo) and candidate.avg_bill_str:
+        return _parse_avg_bill(candidate.avg_bill_str)
+    return None
+
+
+# Сопоставляем семантику ограничения с реальными атрибутами кандидатов
+# (attrgetter поднимает AttributeError, если у модели нет такого поля)
+_CONSTRAINT_VALUE_GETTERS = {
+    "start_time": operator.attrgetter("start_time_naive_event_tz"),
+    "rating": operator.attrgetter("rating"),
+    "name": operator.attrgetter("name"),
+    "price": _get_candidate_price,
+}
+# Вид значения определяет допустимые операторы сравнения
+_CONSTRAINT_ATTRIBUTE_KINDS = {
+    "start_time": "datetime",
+    "price": "numeric",
+    "rating": "numeric",
+    "name": "text",
+}
+# Приведение строкового значения ограничения к типу атрибута
+_CONSTRAINT_VALUE_PARSERS = {
+    "start_time": datetime.fromisoformat,
+    "price": float,
+    "rating": float,
+}
+
+
+def _parse_constraint_value(attribute: str, raw_value: str):
+    """Приводит строковое значение ограничения к типу атрибута."""
+    parse_value = _CONSTRAINT_VALUE_PARSERS.get(attribute)
+    return parse_value(raw_value) if parse_value else raw_value
+
+
+_CONSTRAINT_COMPARATORS = {
+    ("datetime", "GREATER_THAN"): operator.gt,
+    ("datetime", "LESS_THAN"): operator.lt,
+    ("numeric", "GREATER_THAN"): operator.gt,
+    ("numeric", "LESS_THAN"): operator.lt,
+    ("text", "NOT_EQUALS"): operator.ne,
+    ("text", "EQUALS"): operator.eq,
+}
+
+
+def _compile_constraint(constr: Constraint, expansion_minutes: int = 0):
+    """
+    Готовит ограничение к применению: (получатель значения, компаратор, граница).
+    Для MIN/MAX компаратор None - достаточно, чтобы значение было задано.
+    Возвращает None для неизвестного атрибута (ограничение игнорируется) и
+    выбрасывает ValueError, если ограничению не может соответствовать ни один кандидат.
+    """
+    # Проверка вне кэша, чтобы предупреждение писалось при каждом применении
+    if constr.attribute not in _CONSTRAINT_VALUE_GETTERS:
         logger.warning(f"Неизвестный атрибут для фильтрации: {constr.attribute}")
-        return candidates
+        return None
+    return _compile_constraint_fields(
+        constr.attribute, constr.operator, constr.value, expansion_minutes
+    )
 
-    # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
 
-    # Вспомогательная функция для безопасного приведения типов
-    def get_typed_value(value_str: str, target_type: str):
-        if target_type == "datetime":
-            return datetime.fromisoformat(value_str)
-        if target_type == "float":
-            return float(value_str)
-        return value_str
+@lru_cache(maxsize=1024)
+def _compile_constraint_fields(
+    attribute: str, op: str, raw_value: Optional[str], expansion_minutes: int
+):
+    """
+    Компилирует ограничение по значениям его полей. Кэшируется: результат
+    зависит только от них, поэтому разбор значения, выбор компаратора и
+    расчет границы не повторяются при повторном применении ограничения.
+    Атрибут уже проверен в _compile_constraint.
+    """
+    get_value = _CONSTRAINT_VALUE_GETTERS[attribute]
 
-    is_numeric = constr.attribute in ["price", "rating"]
-    is_datetime = constr.attribute == "start_time"
+    # MIN/MAX - это предпочтение сортировки, значение ограничения не используется
+    if op in _SORT_OPERATORS:
+        return get_value, None, None
 
     try:
-        # Для цены значение всегда числовое
-        if constr.attribute == "price":
-            target_value = get_typed_value(constr.value, "float")
-        elif is_datetime:
-            target_value = get_typed_value(constr.value, "datetime")
-        else:
-            target_value = constr.value
+        target_value = _parse_constraint_value(attribute, raw_value)
     except (ValueError, TypeError):
-        logger.error(
-            f"Не удалось распарсить значение '{constr.value}' для атрибута '{constr.attribute}'"
+        raise ValueError(
+            f"Не удалось распарсить значение '{raw_value}' для атрибута '{attribute}'"
         )
-        return []
 
-    for candidate in candidates:
-        # --- НАЧАЛО ИСПРАВЛЕНИЯ ---
-        # Если наш атрибут - это функция (как для цены), вызываем ее. Иначе - getattr.
-        if callable(model_attribute_or_getter):
-            cand_value = model_attribute_or_getter(candidate)
-        else:
-            cand_value = getattr(candidate, model_attribute_or_getter, None)
-        # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
+    value_kind = _CONSTRAINT_ATTRIBUTE_KINDS[attribute]
+    comparator = _CONSTRAINT_COMPARATORS.get((value_kind, op))
+    if comparator is None:
+        raise ValueError(
+            f"Оператор '{op}' не применим к атрибуту '{attribute}'"
+        )
 
-        if cand_value is None:
-            continue
+    bound = target_value
+    # Без расширения граница совпадает с целевым значением, timedelta не нужна
+    if value_kind == "datetime" and expansion_minutes:
+        expansion = timedelta(minutes=expansion_minutes)
+        bound = target_value - expansion if op == "GREATER_THAN" else target_value + expansion
+    return get_value, comparator, bound
 
-        if constr.operator in ["MIN", "MAX"]:
-            new_filtered_list.append(candidate)
-            continue
 
-        is_match = False
+def _candidate_matches(candidate: PlanItem, predicates: list) -> bool:
+    """Проверяет кандидата против всех подготовленных ограничений."""
+    for get_value, comparator, bound in predicates:
         try:
-            if is_datetime:
-                lower_bound = target_value - timedelta(minutes=expansion_minutes)
-                upper_bound = target_value + timedelta(minutes=expansion_minutes)
-                if constr.operator == "GREATER_THAN":
-                    is_match = cand_value > lower_bound
-                if constr.operator == "LESS_THAN":
-                    is_match = cand_value < upper_bound
-            elif is_numeric:
-                if constr.operator == "GREATER_THAN":
-                    is_match = cand_value > target_value
-                if constr.operator == "LESS_THAN":
-                    is_match = cand_value < target_value
-            else:  # Для строковых атрибутов, как 'name'
-                if constr.operator == "NOT_EQUALS":
-                    is_match = cand_value != target_value
-                if constr.operator == "EQUALS":
-                    is_match = cand_value == target_value
-        except TypeError:
+            # attrgetter поднимает AttributeError, если у модели нет такого поля
+            value = get_value(candidate)
+        except AttributeError:
+            return False
+        if value is None:
+            return False
+        if comparator is None:
             continue
+        try:
+            if not comparator(value, bound):
+                return False
+        except TypeError:
+            # Несравнимые значения: такой кандидат не подходит
+            return False
+    return True
+
+
+def _column_masks(
+    candidates: List[PlanItem], predicate, bounds: tuple
+) -> Optional[List[List[bool]]]:
+    """
+    Векторный путь фильтрации: столбец значений атрибута извлекается одним
+    map(), сравнение с каждой из границ - отдельным map(), все циклы на C.
+    Столбец извлекается один раз, сколько бы границ ни проверялось.
+    Возвращает None, если столбец неоднородный (нет поля, None, несравнимые
+    значения) - тогда кандидаты проверяются по одному в _candidate_matches.
+    """
+    get_value, comparator, _ = predicate
+    try:
+        values = list(map(get_value, candidates))
+        if comparator is None:
+            mask = list(map(operator.is_not, values, repeat(None)))
+            return [mask] * len(bounds)
+        if None in values:
+            return None
+        return [list(map(comparator, values, repeat(bound))) for bound in bounds]
+    except (AttributeError, TypeError):
+        return None
+
+
+def _column_mask(candidates: List[PlanItem], predicate) -> Optional[List[bool]]:
+    """Маска одного подготовленного ограничения по его собственной границе."""
+    masks = _column_masks(candidates, predicate, (predicate[2],))
+    return masks[0] if masks is not None else None
+
+
+def _apply_constraints(
+    candidates: List[PlanItem],
+    constraints: List[Constraint],
+    expansion_minutes: int = 0,
+) -> List[PlanItem]:
+    """
+    Применяет семантические ограничения к списку кандидатов.
+    Версия 3.0: все ограничения проверяются за один проход по кандидатам.
+    """
+    predicates = []
+    for constr in constraints:
+        try:
+            compiled = _compile_constraint(constr, expansion_minutes)
+        except ValueError as e:
+            logger.error(str(e))
+            return []
+        if compiled is not None:
+            predicates.append(compiled)
+
+    if not predicates:
+        return candidates
 
-        if is_match:
-            new_filtered_list.append(candidate)
+    # Кандидаты одного типа однородны, поэтому обычно работает векторный путь:
+    # маски по каждому ограничению объединяются поэлементным "и"
+    mask = None
+    for predicate in predicates:
+        column_mask = _column_mask(candidates, predicate)
+        if column_mask is None:
+            return [c for c in candidates if _candidate_matches(c, predicates)]
+        mask = column_mask if mask is None else list(map(operator.and_, mask, column_mask))
+    return list(compress(candidates, mask))
+
+
+def _apply_constraints_with_expansion(
+    candidates: List[PlanItem],
+    constraints: List[Constraint],
+    expansion_minutes: int,
+) -> Tuple[List[PlanItem], bool]:
+    """
+    Применяет ограничения с запасным расширением временного диапазона.
+    Точная и расширенная границы сравниваются с одним и тем же столбцом
+    значений, поэтому кандидаты обходятся один раз, а не двумя проходами.
+    Возвращает (кандидаты, было_ли_применено_расширение).
+    """
+    strict_predicates, loose_bounds = [], []
+    for constr in constraints:
+        try:
+            strict = _compile_constraint(constr)
+            loose = _compile_constraint(constr, expansion_minutes)
+        except ValueError as e:
+            logger.error(str(e))
+            return [], False
+        if strict is not None:
+            strict_predicates.append(strict)
+            loose_bounds.append(loose[2])
+
+    if not strict_predicates:
+        return candidates, False
+
+    strict_mask = loose_mask = None
+    for predicate, loose_bound in zip(strict_predicates, loose_bounds):
+        masks = _column_masks(candidates, predicate, (predicate[2], loose_bound))
+        if masks is None:
+            # Неоднородный столбец: поштучная проверка, расширение - только при пустом результате
+            strict_result = _apply_constraints(candidates, constraints)
+            if strict_result:
+                return strict_result, False
+            return _apply_constraints(candidates, constraints, expansion_minutes), True
+        if strict_mask is None:
+            strict_mask, loose_mask = masks
+        else:
+            strict_mask = list(map(operator.and_, strict_mask, masks[0]))
+            loose_mask = list(map(operator.and_, loose_mask, masks[1]))
 
-    return new_filtered_list
+    if any(strict_mask):
+        return list(compress(candidates, strict_mask)), False
+    return list(compress(candidates, loose_mask)), True
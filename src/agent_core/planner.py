@@ -1,10 +1,13 @@
 # --- НАЧАЛО БЛОКА ДЛЯ ЗАМЕНЫ: planner.py ---
 
+import asyncio
 import logging
 import itertools
+import operator
 from datetime import datetime, timedelta, time
 from typing import List, Union, Optional, Dict, Any, Tuple
 from collections import Counter
+from types import MappingProxyType
 
 from src.agent_core.schedule_parser import parse_schedule_and_check_open
 from src.agent_core.state import AgentState, PlanItem
@@ -16,15 +19,44 @@ from src.schemas.data_schemas import (
     PlanBuilderResult,
     ChangeRequest,
     OrderedActivityItem,
-    RouteSegment,  # <-- ВАЖНО: Убедитесь, что этот импорт будет работать
+    RouteSegmentDict,
 )
-from src.services.gis_service import get_route
+from src.services.gis_service import ROUTE_CACHE_COORDS_PRECISION, get_route
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_POI_DURATION_MINUTES = 30
 MAX_ROUTES_TO_CALCULATE = 25
+# Сколько маршрутов предварительно запрашивается одновременно
+ROUTE_PREFETCH_CONCURRENCY = 10
 DEFAULT_START_HOUR = 9
+# Пустой словарь только для чтения для отсутствующих полей состояния
+_EMPTY_MAP = MappingProxyType({})
+# Атрибут ограничения -> поле модели кандидата для сортировки
+_SORT_ATTRIBUTE_MAP = MappingProxyType(
+    {
+        "price": "min_price",
+        "rating": "rating",
+        "start_time": "start_time_naive_event_tz",
+    }
+)
+_DEFAULT_START_TIME = time(hour=DEFAULT_START_HOUR)
+
+
+def _sorted_candidates(
+    candidates: List[PlanItem], sort_attribute: str, reverse: bool
+) -> List[PlanItem]:
+    """Сортирует кандидатов по полю модели; кандидаты без значения - в конце."""
+    missing = 0 if reverse else float("inf")
+    get_value = operator.attrgetter(sort_attribute)
+
+    def sort_key(candidate: PlanItem):
+        try:
+            return get_value(candidate) or missing
+        except AttributeError:
+            return missing
+
+    return sorted(candidates, key=sort_key, reverse=reverse)
 
 
 class PlanBuilder:
@@ -37,7 +69,7 @@ class PlanBuilder:
         self.state = state
         self.criteria = state.get("search_criteria")
         self.plan_warnings = state.get("plan_warnings", [])
-        self.pinned_items: Dict[str, PlanItem] = state.get("pinned_items", {})
+        self.pinned_items: Dict[str, PlanItem] = state.get("pinned_items") or _EMPTY_MAP
         self.is_flexible_start_time = (
             self.criteria.raw_time_description is None if self.criteria else False
         )
@@ -51,31 +83,171 @@ class PlanBuilder:
             # Можно либо выбросить исключение, либо установить дату по умолчанию
             # Для примера установим текущую дату
             state["parsed_dates_iso"] = [datetime.now().isoformat()]
+            state["parsed_start_dt"] = None
 
-        current_date_key = datetime.fromisoformat(
+        # Узел поиска кладет в состояние уже распарсенные datetime
+        parsed_start_dt = state.get("parsed_start_dt") or datetime.fromisoformat(
             state["parsed_dates_iso"][0]
-        ).strftime("%Y-%m-%d")
-        all_cached_candidates = state.get("cached_candidates", {})
+        )
+        current_date_key = parsed_start_dt.strftime("%Y-%m-%d")
+        all_cached_candidates = state.get("cached_candidates") or _EMPTY_MAP
         self.daily_cache: Dict[str, List[PlanItem]] = all_cached_candidates.get(
-            current_date_key, {}
+            current_date_key, _EMPTY_MAP
         )
-        self.user_start_time = datetime.fromisoformat(state["parsed_dates_iso"][0])
+        self.user_start_time = parsed_start_dt
         if self.is_flexible_start_time and not self.pinned_items:
             self.user_start_time = self.user_start_time.replace(
                 hour=DEFAULT_START_HOUR, minute=0, second=0, microsecond=0
             )
-        self.user_end_time = (
-            datetime.fromisoformat(state["parsed_end_dates_iso"][0])
-            if state.get("parsed_end_dates_iso")
-            else self.user_start_time.replace(hour=23, minute=59)
-        )
+        if parsed_end_dt := state.get("parsed_end_dt"):
+            self.user_end_time = parsed_end_dt
+        elif state.get("parsed_end_dates_iso"):
+            self.user_end_time = datetime.fromisoformat(state["parsed_end_dates_iso"][0])
+        else:
+            self.user_end_time = self.user_start_time.replace(hour=23, minute=59)
         self.user_start_coords = state.get("user_start_coordinates")
         self.ordered_activities = (
             self.criteria.ordered_activities if self.criteria else []
         )
         self.route_calculations_count = 0
+        # Производные данные кандидатов (координаты, model_dump) считаются
+        # один раз на кандидата, а не на каждую перебираемую комбинацию
+        self._coords_by_item: Dict[int, Optional[Dict[str, float]]] = {}
+        self._dump_by_item: Dict[int, Dict[str, Any]] = {}
+        # Матрица маршрутов по индексам точек: одни и те же переезды повторяются
+        # во многих комбинациях (особенно при закрепленных элементах)
+        self._route_by_pair: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        # Индекс точки по округленным координатам и быстрый путь по объекту
+        # координат (он один на кандидата благодаря _get_item_coords)
+        self._point_index: Dict[Tuple[float, float], int] = {}
+        self._point_index_by_coords: Dict[int, Tuple[Dict[str, float], int]] = {}
+        # Выставляется, когда нужный маршрут не посчитан, а лимит исчерпан
+        self._route_limit_hit = False
 
     def _get_item_coords(self, item: PlanItem) -> Optional[Dict[str, float]]:
+        key = id(item)
+        if key not in self._coords_by_item:
+            self._coords_by_item[key] = self._compute_item_coords(item)
+        return self._coords_by_item[key]
+
+    def _get_item_dict(self, item: PlanItem) -> Dict[str, Any]:
+        """Возвращает свежую копию model_dump() кандидата для элемента плана."""
+        key = id(item)
+        if key not in self._dump_by_item:
+            self._dump_by_item[key] = item.model_dump()
+        # Копия, так как в элемент плана дописывается travel_info_to_here
+        return dict(self._dump_by_item[key])
+
+    def _point_id(self, coords: Dict[str, float]) -> int:
+        """
+        Индекс точки в матрице маршрутов. Координаты округляются один раз
+        на объект координат, дальше ключ матрицы - пара целых чисел.
+        """
+        entry = self._point_index_by_coords.get(id(coords))
+        # Объект хранится в записи, поэтому его id не переиспользуется
+        if entry is not None and entry[0] is coords:
+            return entry[1]
+        rounded = (
+            round(coords["lon"], ROUTE_CACHE_COORDS_PRECISION),
+            round(coords["lat"], ROUTE_CACHE_COORDS_PRECISION),
+        )
+        index = self._point_index.setdefault(rounded, len(self._point_index))
+        self._point_index_by_coords[id(coords)] = (coords, index)
+        return index
+
+    def _route_key(
+        self, origin: Dict[str, float], destination: Dict[str, float]
+    ) -> Tuple[int, int]:
+        return self._point_id(origin), self._point_id(destination)
+
+    async def _get_route_between(
+        self, origin: Dict[str, float], destination: Dict[str, float]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Маршрут между двумя точками с запоминанием на время построения плана.
+        Лимит MAX_ROUTES_TO_CALCULATE расходуется только на новые пары;
+        None означает, что лимит исчерпан.
+        """
+        key = self._route_key(origin, destination)
+        route_info = self._route_by_pair.get(key)
+        if route_info is None:
+            if self.route_calculations_count >= MAX_ROUTES_TO_CALCULATE:
+                self._route_limit_hit = True
+                return None
+            self.route_calculations_count += 1
+            # Неудачный ответ тоже запоминается: повторять его в этой же сборке бессмысленно
+            route_info = await get_route(points=[origin, destination])
+            self._route_by_pair[key] = route_info
+        return route_info
+
+    def _collect_route_pairs(
+        self, activity_slots: List[List[PlanItem]], limit: int
+    ) -> Dict[Tuple[int, int], Tuple[Dict, Dict]]:
+        """
+        Собирает еще не посчитанные пары соседних точек в порядке перебора
+        комбинаций, не больше limit штук. Порядок совпадает с тем, в котором
+        пары понадобятся основному циклу, поэтому лимит тратится на них первыми.
+        Пары после мероприятия, на которое заведомо не успеть по времени,
+        не собираются: основной цикл отбросит такой префикс без маршрута.
+        """
+        pairs: Dict[Tuple[int, int], Tuple[Dict, Dict]] = {}
+        if limit <= 0:
+            return pairs
+        for combination in itertools.product(*activity_slots):
+            previous_coords = self.user_start_coords
+            # Нижняя оценка времени окончания предыдущего шага (без учета дороги)
+            earliest_end = self.user_start_time
+            for item in combination:
+                if isinstance(item, Event):
+                    if item.start_time_naive_event_tz < earliest_end:
+                        break
+                    earliest_end = item.start_time_naive_event_tz + timedelta(
+                        minutes=item.duration_minutes or 120
+                    )
+                    if earliest_end > self.user_end_time:
+                        break
+                coords = self._get_item_coords(item)
+                if previous_coords and coords:
+                    key = self._route_key(previous_coords, coords)
+                    if key not in pairs and key not in self._route_by_pair:
+                        pairs[key] = (previous_coords, coords)
+                        if len(pairs) >= limit:
+                            return pairs
+                previous_coords = coords
+        return pairs
+
+    async def _prefetch_routes(self, activity_slots: List[List[PlanItem]]) -> None:
+        """
+        Запрашивает маршруты для уникальных пар соседних точек параллельно,
+        до основного цикла: его проверки совместимости затем берут маршруты
+        из памяти, и задержка равна самому долгому запросу, а не их сумме.
+        """
+        pairs = self._collect_route_pairs(
+            activity_slots, MAX_ROUTES_TO_CALCULATE - self.route_calculations_count
+        )
+        if not pairs:
+            return
+        logger.info(f"PlanBuilder: Предварительно запрашиваю {len(pairs)} маршрутов.")
+        semaphore = asyncio.Semaphore(ROUTE_PREFETCH_CONCURRENCY)
+
+        async def fetch(origin: Dict[str, float], destination: Dict[str, float]):
+            async with semaphore:
+                return await get_route(points=[origin, destination])
+
+        results = await asyncio.gather(
+            *[fetch(origin, destination) for origin, destination in pairs.values()],
+            return_exceptions=True,
+        )
+        for key, result in zip(pairs, results):
+            if isinstance(result, Exception):
+                # Лимит не расходуется: пара будет запрошена по требованию
+                logger.warning(f"Не удалось предварительно получить маршрут: {result}")
+                continue
+            self.route_calculations_count += 1
+            self._route_by_pair[key] = result
+
+    @staticmethod
+    def _compute_item_coords(item: PlanItem) -> Optional[Dict[str, float]]:
         if isinstance(item, Event) and item.place_coords_lon and item.place_coords_lat:
             return {"lon": item.place_coords_lon, "lat": item.place_coords_lat}
         if isinstance(item, (ParkInfo, FoodPlaceInfo)) and item.coords:
@@ -85,31 +257,50 @@ class PlanBuilder:
     async def _check_compatibility(
         self, last_item_state: Dict[str, Any], item_to_add: PlanItem
     ) -> Dict[str, Any]:
-        # (Этот метод остается без изменений, он уже корректен)
-        if self.route_calculations_count >= MAX_ROUTES_TO_CALCULATE:
-            return {"compatible": False, "reason": "Превышен лимит расчетов маршрутов."}
         last_item_end_time = last_item_state["end_time"]
         last_item_coords = last_item_state["coords"]
         item_to_add_coords = self._get_item_coords(item_to_add)
         item_name = getattr(item_to_add, "name", "N/A")
         travel_seconds, travel_info = 0, None
+        # Время мероприятия от дороги не зависит: заведомо неподходящее
+        # отсекается до запроса маршрута, не расходуя лимит
+        if isinstance(item_to_add, Event):
+            if last_item_end_time > item_to_add.start_time_naive_event_tz:
+                return {
+                    "compatible": False,
+                    "reason": f"Вы не успеваете на '{item_name}'.",
+                }
+            if (
+                item_to_add.start_time_naive_event_tz
+                + timedelta(minutes=item_to_add.duration_minutes or 120)
+                > self.user_end_time
+            ):
+                return {
+                    "compatible": False,
+                    "reason": f"Посещение '{item_name}' не укладывается в ваше время.",
+                }
         if last_item_coords and item_to_add_coords:
-            self.route_calculations_count += 1
-            route_info = await get_route(points=[last_item_coords, item_to_add_coords])
+            route_info = await self._get_route_between(
+                last_item_coords, item_to_add_coords
+            )
+            if route_info is None:
+                return {"compatible": False, "reason": "Превышен лимит расчетов маршрутов."}
             if route_info.get("status") != "success":
                 return {
                     "compatible": False,
                     "reason": f"Не удалось построить маршрут до '{item_name}'.",
                 }
             travel_seconds = route_info.get("duration_seconds", 0)
-            travel_info = RouteSegment(
-                from_name=last_item_state.get("name", "Точка старта"),
-                to_name=item_name,
-                duration_seconds=travel_seconds,
-                distance_meters=route_info.get("distance_meters", 0),
-                from_coords=last_item_coords,
-                to_coords=item_to_add_coords,
-            )
+            # Данные маршрута пришли из get_route, поэтому сегмент собирается
+            # сразу словарем, без валидации pydantic и последующего model_dump()
+            travel_info: RouteSegmentDict = {
+                "from_name": last_item_state.get("name", "Точка старта"),
+                "to_name": item_name,
+                "duration_seconds": travel_seconds,
+                "distance_meters": route_info.get("distance_meters", 0),
+                "from_coords": last_item_coords,
+                "to_coords": item_to_add_coords,
+            }
         arrival_time = last_item_end_time + timedelta(seconds=travel_seconds)
         if isinstance(item_to_add, Event):
             if arrival_time > item_to_add.start_time_naive_event_tz:
@@ -160,21 +351,10 @@ class PlanBuilder:
             return []
         sorting_pref = self.state.get("sorting_preference")
         if sorting_pref and sorting_pref["target"] == activity_type:
-            attr_map = {
-                "price": "min_price",
-                "rating": "rating",
-                "start_time": "start_time_naive_event_tz",
-            }
-            sort_attribute = attr_map.get(sorting_pref["attribute"])
+            sort_attribute = _SORT_ATTRIBUTE_MAP.get(sorting_pref["attribute"])
             if sort_attribute:
-                reverse_order = True if sorting_pref["order"] == "MAX" else False
-                candidates = sorted(
-                    candidates,
-                    key=lambda x: getattr(
-                        x, sort_attribute, 0 if reverse_order else float("inf")
-                    )
-                    or (0 if reverse_order else float("inf")),
-                    reverse=reverse_order,
+                candidates = _sorted_candidates(
+                    candidates, sort_attribute, reverse=sorting_pref["order"] == "MAX"
                 )
             self.state["sorting_preference"] = None
         if (
@@ -186,7 +366,7 @@ class PlanBuilder:
                 c
                 for c in candidates
                 if isinstance(c, Event)
-                and c.start_time_naive_event_tz.time() >= time(hour=DEFAULT_START_HOUR)
+                and c.start_time_naive_event_tz.time() >= _DEFAULT_START_TIME
             ]
         return candidates
 
@@ -222,63 +402,75 @@ class PlanBuilder:
 
         possible_plans: List[Plan] = []
         rejection_reasons = []
+        self._route_limit_hit = False
+        await self._prefetch_routes(activity_slots)
+        # Лучшее ненулевое время в пути среди полных планов: ветки, чей
+        # частичный путь уже длиннее, не могут дать лучший план и отсекаются
+        best_travel = float("inf")
+        chosen_items: List[Dict[str, Any]] = []
+
+        async def extend(slot_index: int, last_item_state: Dict[str, Any], partial_travel: int):
+            nonlocal best_travel
+            # 6. Все слоты заполнены: сохраняем план
+            if slot_index == len(activity_slots):
+                possible_plans.append(
+                    Plan(items=list(chosen_items), total_travel_seconds=partial_travel)
+                )
+                if 0 < partial_travel < best_travel:
+                    best_travel = partial_travel
+                return
 
-        # 1. Перебираем все комбинации кандидатов
-        for combination in itertools.product(*activity_slots):
-            if self.route_calculations_count >= MAX_ROUTES_TO_CALCULATE:
-                break
-
-            current_plan_items = []
-            is_combination_possible = True
-
-            # 2. Устанавливаем НАЧАЛЬНОЕ состояние для КАЖДОЙ новой комбинации
-            # Это состояние "до" первого мероприятия.
-            # Для предварительного плана user_start_coords будет None.
-            last_item_state = {
-                "end_time": self.user_start_time,
-                "coords": self.user_start_coords,
-                "name": "Точка старта",
-            }
-
-            # 3. Последовательно обрабатываем каждый элемент в комбинации
-            for item_to_add in combination:
+            for item_to_add in activity_slots[slot_index]:
+                # Перебор останавливается на первом маршруте, не уместившемся в лимит
+                if self._route_limit_hit:
+                    return
 
-                # 4. Проверяем совместимость, передавая состояние от ПРЕДЫДУЩЕГО шага
+                # Проверяем совместимость, передавая состояние от ПРЕДЫДУЩЕГО шага
                 check_result = await self._check_compatibility(
                     last_item_state, item_to_add
                 )
-
-                if check_result["compatible"]:
-                    # Если элемент подходит, создаем для него словарь
-                    activity_dict = check_result["item"].model_dump()
-
-                    # Явно добавляем информацию о маршруте, если она была рассчитана
-                    if travel_info := check_result.get("travel_info"):
-                        activity_dict["travel_info_to_here"] = travel_info.model_dump()
-
-                    current_plan_items.append(activity_dict)
-
-                    # 5. ОБНОВЛЯЕМ состояние для СЛЕДУЮЩЕГО шага
-                    last_item_state = {
+                if not check_result["compatible"]:
+                    # Элемент не подошел: все продолжения этого префикса невозможны
+                    rejection_reasons.append(check_result)
+                    continue
+
+                travel_info = check_result.get("travel_info")
+                travel = partial_travel + (travel_info["duration_seconds"] if travel_info else 0)
+                if travel > best_travel:
+                    continue
+
+                # Если элемент подходит, создаем для него словарь
+                activity_dict = self._get_item_dict(check_result["item"])
+                # Явно добавляем информацию о маршруте, если она была рассчитана
+                if travel_info:
+                    activity_dict["travel_info_to_here"] = travel_info
+
+                # Состояние для СЛЕДУЮЩЕГО шага
+                chosen_items.append(activity_dict)
+                await extend(
+                    slot_index + 1,
+                    {
                         "end_time": check_result["end_time"],
                         "coords": check_result["coords"],
                         "name": check_result["name"],
-                    }
-                else:
-                    # Если хоть один элемент не подошел, вся комбинация невозможна
-                    is_combination_possible = False
-                    rejection_reasons.append(check_result)
-                    break  # Прерываем цикл по элементам, переходим к след. комбинации
-
-            # 6. Если вся комбинация успешно обработана, создаем и сохраняем план
-            if is_combination_possible:
-                total_travel = sum(
-                    item.get("travel_info_to_here", {}).get("duration_seconds", 0)
-                    for item in current_plan_items
-                )
-                possible_plans.append(
-                    Plan(items=current_plan_items, total_travel_seconds=total_travel)
+                    },
+                    travel,
                 )
+                chosen_items.pop()
+
+        # 1. Перебираем комбинации поиском в глубину в том же порядке, что и
+        # itertools.product: проверка общего префикса выполняется один раз на
+        # все его продолжения, а не заново для каждой комбинации.
+        # Для предварительного плана user_start_coords будет None.
+        await extend(
+            0,
+            {
+                "end_time": self.user_start_time,
+                "coords": self.user_start_coords,
+                "name": "Точка старта",
+            },
+            0,
+        )
 
         if not possible_plans:
             logger.warning("Не найдено ни одной совместимой комбинации.")
@@ -405,13 +597,15 @@ class PlanBuilder:
                         model_to_use = all_item_models[activity_type_key]
 
                     if model_to_use:
-                        # Убираем служебное поле перед валидацией
-                        item_data_for_validation = item_dict.copy()
-                        if "travel_info_to_here" in item_data_for_validation:
-                            del item_data_for_validation["travel_info_to_here"]
-
-                        parsed_item = model_to_use.model_validate(
-                            item_data_for_validation
+                        # Элементы плана - это model_dump() уже провалидированных
+                        # кандидатов, поэтому собираем модель без повторной валидации,
+                        # отбрасывая служебное поле
+                        parsed_item = model_to_use.model_construct(
+                            **{
+                                k: v
+                                for k, v in item_dict.items()
+                                if k != "travel_info_to_here"
+                            }
                         )
                         new_pinned_items[activity_type_key] = parsed_item
                     else:
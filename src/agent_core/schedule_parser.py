@@ -18,6 +18,14 @@ DAYS_MAP_RU_TO_INT = {
 }
 DAYS_INT_TO_RU_SHORT = {v: k for k, v in DAYS_MAP_RU_TO_INT.items()}
 
+# Паттерны компилируются один раз: парсер вызывается PlanBuilder'ом
+# для каждого места в каждой перебираемой комбинации
+_SCHEDULE_LINE_RE = re.compile(r"([А-Яа-яЁё\s,–-]+?)\s*(\d{2}:\d{2})\s*–\s*(\d{2}:\d{2})")
+_TIME_RANGE_RE = re.compile(r"(\d{2}:\d{2})\s*–\s*(\d{2}:\d{2})")
+_DAILY_LINE_RE = re.compile(r"(.*?)\s*(\d{2}:\d{2})\s*–\s*(\d{2}:\d{2})")
+_DAY_TOKENS_SPLIT_RE = re.compile(r"[,\s]+")
+_DAY_RANGE_SPLIT_RE = re.compile(r"[–-]")
+
 
 def _parse_time_str_schedule(
     time_str: str, base_date: datetime.date, is_closing_time: bool = False
@@ -85,12 +93,10 @@ def parse_schedule_and_check_open(
         logger_schedule.debug(
             f"SCHEDULE_PARSER_CHECK_OPEN ({poi_name_for_log}): Processing line {line_idx+1}/{len(lines)}: '{line}'"
         )
-        match = re.match(
-            r"([А-Яа-яЁё\s,–-]+?)\s*(\d{2}:\d{2})\s*–\s*(\d{2}:\d{2})", line
-        )
+        match = _SCHEDULE_LINE_RE.match(line)
         if not match:
             if "ежедневно" in line.lower():
-                time_match_daily = re.search(r"(\d{2}:\d{2})\s*–\s*(\d{2}:\d{2})", line)
+                time_match_daily = _TIME_RANGE_RE.search(line)
                 if time_match_daily:
                     days_range_str_daily = "Пн–Вс"
                     open_time_str_daily, close_time_str_daily = (
@@ -99,9 +105,8 @@ def parse_schedule_and_check_open(
                     logger_schedule.debug(
                         f"SCHEDULE_PARSER_CHECK_OPEN ({poi_name_for_log}): 'ежедневно' found with times {open_time_str_daily}-{close_time_str_daily}"
                     )
-                    match_temp_obj_daily = re.match(
-                        r"(.*?)\s*(\d{2}:\d{2})\s*–\s*(\d{2}:\d{2})",
-                        f"{days_range_str_daily} {open_time_str_daily}–{close_time_str_daily}",
+                    match_temp_obj_daily = _DAILY_LINE_RE.match(
+                        f"{days_range_str_daily} {open_time_str_daily}–{close_time_str_daily}"
                     )  # Simulate full match
                     if match_temp_obj_daily:
                         match = match_temp_obj_daily
@@ -126,7 +131,7 @@ def parse_schedule_and_check_open(
             f"SCHEDULE_PARSER_CHECK_OPEN ({poi_name_for_log}): Matched line. Days part: '{days_part_str}', Open: '{open_time_str}', Close: '{close_time_str}'"
         )
         current_days_in_rule: List[int] = []
-        day_tokens = re.split(r"[,\s]+", days_part_str.strip())
+        day_tokens = _DAY_TOKENS_SPLIT_RE.split(days_part_str.strip())
 
         for token_idx_val, token_val in enumerate(day_tokens):
             if not token_val:
@@ -135,8 +140,8 @@ def parse_schedule_and_check_open(
                 f"SCHEDULE_PARSER_CHECK_OPEN ({poi_name_for_log}): Processing day token {token_idx_val+1}: '{token_val}'"
             )
             if "–" in token_val or "-" in token_val:
-                day_start_str_token_val, day_end_str_token_val = re.split(
-                    r"[–-]", token_val
+                day_start_str_token_val, day_end_str_token_val = _DAY_RANGE_SPLIT_RE.split(
+                    token_val
                 )
                 day_start_int_token_val = DAYS_MAP_RU_TO_INT.get(
                     day_start_str_token_val
@@ -1,6 +1,7 @@
 # Файл: src/agent_core/state.py (ПОЛНАЯ ИСПРАВЛЕННАЯ ВЕРСИЯ)
-from typing import TypedDict, Optional, List, Annotated, Union, Dict, Any
+from typing import TypedDict, Optional, List, Annotated, Union, Dict, Any, Tuple, Deque
 from operator import add
+from datetime import datetime
 from langchain_core.messages import BaseMessage
 from src.schemas.data_schemas import (
     ExtractedInitialInfo,
@@ -46,11 +47,13 @@ class AgentState(TypedDict):
     plan_builder_result: Optional[PlanBuilderResult]
     analyzed_feedback: Optional[AnalyzedFeedback]
     pinned_items: Dict[str, PlanItem]
-    command_queue: List[ChangeRequest]
+    command_queue: Deque[ChangeRequest]
     sorting_preference: Optional[SortingPreference]
     city_id_afisha: Optional[int]
     parsed_dates_iso: Optional[List[str]]
     parsed_end_dates_iso: Optional[List[str]]
+    parsed_start_dt: Optional[datetime] # То же, что parsed_dates_iso[0], но уже распарсенное
+    parsed_end_dt: Optional[datetime]
     user_start_coordinates: Optional[dict]
     is_awaiting_address: bool
     status_message_id: Optional[Any]
@@ -58,4 +61,5 @@ class AgentState(TypedDict):
     is_awaiting_start_address: bool
     is_awaiting_criteria_clarification: bool # Флаг, что мы ждем уточнения по обязательным критериям
     missing_criteria_fields: List[str] # Список полей, которые мы ожидаем получить (например, ['city', 'dates_description'])
-    last_clarification_question: Optional[str] # Последний вопрос, заданный пользователю для уточнения
\ No newline at end of file
+    last_clarification_question: Optional[str] # Последний вопрос, заданный пользователю для уточнения
+    speculative_extraction: Optional[Tuple[Optional[ExtractedInitialInfo], Optional[str]]] # Результат спекулятивного извлечения критериев из classify_intent_node
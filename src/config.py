@@ -20,6 +20,15 @@ class Settings:
         "AFISHA_PROXY_BASE_URL", "http://localhost:8000"
     )
 
+    # Agent
+    # Спекулятивно извлекать критерии параллельно с классификацией намерения.
+    # Экономит один round-trip к LLM на PLAN_REQUEST ценой лишних токенов.
+    ENABLE_SPECULATIVE_EXTRACT: bool = (
+        os.getenv("ENABLE_SPECULATIVE_EXTRACT", "true").lower() == "true"
+    )
+    # Максимальное число одновременных запросов к LLM на весь процесс
+    AGENT_LLM_CONCURRENCY: int = int(os.getenv("AGENT_LLM_CONCURRENCY", "8"))
+
     # Logging
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
 
@@ -1,18 +1,28 @@
 # Файл: src/gigachat_client.py
 from langchain_gigachat import GigaChat
+from langchain_core.runnables import Runnable
 from langchain_core.tools import BaseTool
-from typing import List, Optional
+from contextlib import aclosing
+from functools import lru_cache
+from typing import Any, List, Optional
+import asyncio
 import logging
 
 from src.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Общий лимит одновременных запросов к LLM для всего агента,
+# чтобы параллельные узлы не упирались в rate limit провайдера.
+_llm_semaphore = asyncio.Semaphore(settings.AGENT_LLM_CONCURRENCY)
 
-def get_gigachat_client(tools: Optional[List[BaseTool]] = None) -> GigaChat:
+
+@lru_cache(maxsize=1)
+def _get_base_client() -> GigaChat:
     """
-    Создает и возвращает НОВЫЙ экземпляр клиента GigaChat при каждом вызове.
-    Это гарантирует изоляцию между тестами и предотвращает ошибки с "закрытым циклом событий".
+    Создает единственный экземпляр клиента GigaChat на процесс.
+    Клиент держит внутри HTTP-соединения и токен доступа, поэтому
+    повторное использование экономит TLS-рукопожатие и обновление токена.
     """
     if not settings.GIGACHAT_CREDENTIALS:
         raise ValueError(
@@ -30,18 +40,90 @@ def get_gigachat_client(tools: Optional[List[BaseTool]] = None) -> GigaChat:
         "max_tokens": 650,
     }
 
-    logger.debug("Созданыие нового экземпляра GigaChat клиента.")
+    logger.debug("Создание общего экземпляра GigaChat клиента.")
+    return GigaChat(**client_params)
+
+
+def reset_gigachat_client() -> None:
+    """
+    Сбрасывает общий клиент GigaChat (например, между тестами,
+    чтобы не тянуть соединения из уже закрытого цикла событий).
+    Вместе с ним сбрасываются и привязки structured output к старому клиенту.
+    """
+    _get_base_client.cache_clear()
+    get_structured_llm.cache_clear()
+
 
-    # Создаем новый клиент
-    new_client = GigaChat(**client_params)
+async def aclose_gigachat_client() -> None:
+    """
+    Закрывает HTTP-соединения общего клиента GigaChat и сбрасывает его.
+    Вызывается при остановке приложения, пока цикл событий еще жив.
+    """
+    if _get_base_client.cache_info().currsize:
+        # Внутренний клиент пакета gigachat владеет HTTP-соединениями
+        inner_client = getattr(_get_base_client(), "_client", None)
+        aclose = getattr(inner_client, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception as e:
+                logger.warning(f"Не удалось закрыть клиент GigaChat: {e}")
+    reset_gigachat_client()
+
+
+def get_gigachat_client(tools: Optional[List[BaseTool]] = None) -> GigaChat:
+    """
+    Возвращает общий экземпляр клиента GigaChat.
+    Если переданы инструменты, привязывает их к общему клиенту.
+    """
+    client = _get_base_client()
 
     # Если переданы инструменты, привязываем их
     if tools:
         try:
-            return new_client.bind_tools(tools)
+            return client.bind_tools(tools)
         except Exception as e:
             logger.error(f"Не удалось привязать инструменты к GigaChat: {e}")
-            return new_client
+            return client
 
     # Возвращаем клиент без инструментов
-    return new_client
+    return client
+
+
+@lru_cache(maxsize=None)
+def get_structured_llm(schema_cls: type) -> Runnable:
+    """
+    Возвращает закэшированную привязку with_structured_output для схемы.
+    JSON-схема модели сериализуется один раз, а не на каждый запрос.
+    Кэш живет рядом с общим клиентом, чтобы reset_gigachat_client сбрасывал оба.
+    """
+    return get_gigachat_client().with_structured_output(schema_cls)
+
+
+async def bounded_ainvoke(runnable: Runnable, *args: Any, **kwargs: Any) -> Any:
+    """
+    Вызывает runnable.ainvoke, соблюдая общий лимит одновременных запросов к LLM.
+    """
+    async with _llm_semaphore:
+        return await runnable.ainvoke(*args, **kwargs)
+
+
+async def bounded_astream_until(
+    runnable: Runnable, stop_marker: str, *args: Any, **kwargs: Any
+) -> str:
+    """
+    Стримит ответ и прекращает генерацию, как только в тексте появился
+    stop_marker. Возвращает текст, собранный к этому моменту (включая маркер).
+    Полезно, когда после нужного блока модель дописывает ненужный хвост.
+    """
+    chunks: List[str] = []
+    tail = ""
+    async with _llm_semaphore:
+        async with aclosing(runnable.astream(*args, **kwargs)) as stream:
+            async for chunk in stream:
+                chunks.append(chunk.content)
+                # Маркер может прийти разбитым на несколько чанков
+                tail = tail[-len(stop_marker):] + chunk.content
+                if stop_marker in tail:
+                    break
+    return "".join(chunks)
@@ -1,5 +1,5 @@
 # Файл: src/schemas/data_schemas.py (ФИНАЛЬНАЯ ПОЛНАЯ ВЕРСИЯ)
-from typing import Optional, List, Dict, Any, Union, Literal
+from typing import Optional, List, Dict, Any, Union, Literal, TypedDict
 from pydantic import BaseModel, Field, ConfigDict
 from datetime import datetime
 from enum import Enum
@@ -38,6 +38,21 @@ class RouteSegment(BaseModel):
     )
 
 
+class RouteSegmentDict(TypedDict):
+    """
+    Внутреннее представление RouteSegment в элементах плана.
+    Используется, когда данные уже получены из доверенного источника
+    и валидация через pydantic-модель не нужна.
+    """
+
+    from_name: str
+    to_name: str
+    duration_seconds: int
+    distance_meters: float
+    from_coords: Optional[Dict[str, float]]
+    to_coords: Optional[Dict[str, float]]
+
+
 # Файл: src/schemas/data_schemas.py
 # ДОБАВЬТЕ ЭТИ ДВА КЛАССА В КОНЕЦ ФАЙЛА
 
@@ -58,6 +73,14 @@ class ActivityClassifier(BaseModel):
     reasoning: str = Field(description="Краткое обоснование выбора типа.")
 
 
+class BatchActivityClassification(BaseModel):
+    """Классификация нескольких активностей одним запросом, в исходном порядке."""
+
+    items: List[ActivityClassifier] = Field(
+        description="Результаты классификации, по одному на каждую активность, в том же порядке."
+    )
+
+
 class NewSearchCriteria(BaseModel):
     """Конкретная структура для запроса на 'structural' изменение."""
 
@@ -396,6 +419,45 @@ class SimplifiedExtractedInfo(BaseModel):
     )
 
 
+class ClassifiedActivity(BaseModel):
+    """Одна активность из запроса вместе с ее системным типом."""
+
+    activity_type: Literal[
+        "MOVIE",
+        "PARK",
+        "RESTAURANT",
+        "CONCERT",
+        "STAND_UP",
+        "PERFORMANCE",
+        "MUSEUM_EXHIBITION",
+        "UNKNOWN",
+    ] = Field(description="Системный тип активности.")
+    query_details: str = Field(
+        description="Оригинальная формулировка пользователя для этой активности."
+    )
+
+
+class CombinedExtractedInfo(BaseModel):
+    """
+    Схема для LLM: извлечение критериев и классификация активностей
+    за один вызов вместо извлечения и отдельной классификации каждой активности.
+    """
+
+    city: Optional[str] = Field(None, description="Название города.")
+    dates_description: Optional[str] = Field(
+        None, description="Описание дат или периода, как его дал пользователь."
+    )
+    ordered_activities: List[ClassifiedActivity] = Field(
+        default_factory=list,
+        description="ВСЕ упомянутые активности в порядке упоминания, каждая с системным типом.",
+    )
+    budget: Optional[int] = Field(None, description="Общий бюджет пользователя.")
+    person_count: Optional[int] = Field(1, description="Количество человек.")
+    raw_time_description: Optional[str] = Field(
+        None, description="Необработанное описание времени (e.g., 'вечером')."
+    )
+
+
 class ChangeRequest(BaseModel):
     """Структурированное описание ОДНОЙ атомарной команды от пользователя."""
 
@@ -4,6 +4,7 @@ import asyncio
 from datetime import date, datetime, timezone, time  # Added time
 from typing import Optional, List, Dict, Any, Tuple
 from datetime import timedelta
+from time import monotonic
 
 try:
     from src.config import settings
@@ -91,7 +92,46 @@ async def _make_afisha_request(
     return None
 
 
+CITIES_CACHE_TTL_SECONDS = 3600
+
+# Список городов меняется раз в дни, поэтому держим его в памяти процесса
+_cities_cache: Optional[List[Dict[str, Any]]] = None
+_cities_by_name_lower: Dict[str, Dict[str, Any]] = {}
+_cities_cache_expires_at: float = 0.0
+_cities_cache_lock = asyncio.Lock()
+
+
 async def fetch_cities() -> List[Dict[str, Any]]:
+    """Возвращает список городов Афиши, кэшируя его на CITIES_CACHE_TTL_SECONDS."""
+    global _cities_cache, _cities_by_name_lower, _cities_cache_expires_at
+    # Быстрый путь без блокировки: свежий кэш читается параллельно
+    if _cities_cache is not None and monotonic() < _cities_cache_expires_at:
+        return _cities_cache
+
+    async with _cities_cache_lock:
+        # Кэш мог обновить другой запрос, пока мы ждали блокировку
+        if _cities_cache is not None and monotonic() < _cities_cache_expires_at:
+            return _cities_cache
+
+        cities = await _fetch_cities_from_api()
+        # Пустой ответ - это ошибка API, его не кэшируем
+        if cities:
+            by_name_lower: Dict[str, Dict[str, Any]] = {}
+            for city in cities:
+                by_name_lower.setdefault(city["name_lower"], city)
+            _cities_cache = cities
+            _cities_by_name_lower = by_name_lower
+            _cities_cache_expires_at = monotonic() + CITIES_CACHE_TTL_SECONDS
+        return cities
+
+
+async def find_city_by_name(city_name: str) -> Optional[Dict[str, Any]]:
+    """Ищет город по названию без учета регистра (O(1) по закэшированному индексу)."""
+    await fetch_cities()
+    return _cities_by_name_lower.get(city_name.strip().lower())
+
+
+async def _fetch_cities_from_api() -> List[Dict[str, Any]]:
     async with aiohttp.ClientSession() as session:
         data = await _make_afisha_request(session, "/v3/cities")
         if data is None or not isinstance(data, list):
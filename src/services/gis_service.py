@@ -3,7 +3,9 @@
 import aiohttp
 import logging
 import asyncio
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
+from collections import OrderedDict
+from time import monotonic
 import json
 import re
 
@@ -62,6 +64,51 @@ ROUTING_API_BASE_URL = "https://routing.api.2gis.com/routing/7.0.0/global"
 
 logger = logging.getLogger(__name__)
 
+# --- Кэши геокодинга и маршрутов ---
+# Пользователи часто повторяют один и тот же адрес старта, а маршруты
+# между одними и теми же точками пересчитываются при каждой правке плана.
+GEOCODING_CACHE_TTL_SECONDS = 86400
+GEOCODING_CACHE_MAX_SIZE = 2048
+# Маршруты на авто зависят от пробок, поэтому живут меньше
+ROUTE_CACHE_TTL_SECONDS = 900
+ROUTE_CACHE_MAX_SIZE = 2048
+# Точность округления координат в ключе кэша (~1 м)
+ROUTE_CACHE_COORDS_PRECISION = 5
+
+_ADDRESS_KEY_STRIP_RE = re.compile(r"[^\w]+")
+
+_geocoding_cache: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+_route_cache: "OrderedDict[Tuple, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+
+def _ttl_cache_get(cache: OrderedDict, key) -> Optional[Any]:
+    """Возвращает неистекшее значение из LRU-кэша с TTL или None."""
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if monotonic() >= expires_at:
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    return value
+
+
+def _ttl_cache_put(cache: OrderedDict, key, value, ttl: float, max_size: int) -> None:
+    """Кладет значение в LRU-кэш с TTL, вытесняя самое старое при переполнении."""
+    cache[key] = (monotonic() + ttl, value)
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def _normalize_address_key(text: Optional[str]) -> str:
+    """Нормализует адрес для ключа кэша: регистр, ё, пунктуация и пробелы."""
+    if not text:
+        return ""
+    return " ".join(_ADDRESS_KEY_STRIP_RE.sub(" ", text.lower().replace("ё", "е")).split())
+
+
 # --- Модели данных ---
 
 
@@ -357,6 +404,28 @@ def _extract_contacts(contact_groups_data: Optional[List[Dict[str, Any]]]) -> st
 
 async def get_geocoding_details(
     address: str, city: Optional[str] = None
+) -> GeocodingResult:
+    """Геокодирует адрес. Успешные ответы кэшируются на GEOCODING_CACHE_TTL_SECONDS."""
+    cache_key = (_normalize_address_key(city), _normalize_address_key(address))
+    if (cached := _ttl_cache_get(_geocoding_cache, cache_key)) is not None:
+        logger.info(f"2GIS Geocoding: Результат для '{address}' взят из кэша")
+        return cached.model_copy()
+
+    result = await _fetch_geocoding_details(address, city)
+    # Ошибки API и сети не кэшируем, чтобы следующий запрос повторил попытку
+    if result.match_level != "error":
+        _ttl_cache_put(
+            _geocoding_cache,
+            cache_key,
+            result,
+            GEOCODING_CACHE_TTL_SECONDS,
+            GEOCODING_CACHE_MAX_SIZE,
+        )
+    return result.model_copy()
+
+
+async def _fetch_geocoding_details(
+    address: str, city: Optional[str] = None
 ) -> GeocodingResult:
     if not settings.GIS_API_KEY:  # Проверяем актуальный settings
         return GeocodingResult(
@@ -928,6 +997,35 @@ async def search_food_places(
 
 async def get_route(
     points: List[Dict[str, Any]], transport: str = "driving"
+) -> Dict[str, Any]:
+    """Строит маршрут через 2GIS. Успешные ответы кэшируются на ROUTE_CACHE_TTL_SECONDS."""
+    try:
+        cache_key = (transport,) + tuple(
+            (
+                round(p["lon"], ROUTE_CACHE_COORDS_PRECISION),
+                round(p["lat"], ROUTE_CACHE_COORDS_PRECISION),
+            )
+            for p in points
+        )
+    except (TypeError, KeyError):
+        # Некорректные точки - пусть _fetch_route вернет понятную ошибку
+        cache_key = None
+
+    if cache_key is not None:
+        if (cached := _ttl_cache_get(_route_cache, cache_key)) is not None:
+            logger.debug("2GIS Routing: Маршрут взят из кэша")
+            return dict(cached)
+
+    result = await _fetch_route(points, transport)
+    if cache_key is not None and result.get("status") == "success":
+        _ttl_cache_put(
+            _route_cache, cache_key, result, ROUTE_CACHE_TTL_SECONDS, ROUTE_CACHE_MAX_SIZE
+        )
+    return dict(result)
+
+
+async def _fetch_route(
+    points: List[Dict[str, Any]], transport: str = "driving"
 ) -> Dict[str, Any]:
     if not settings.GIS_API_KEY:
         return {"status": "error", "message": "API ключ не настроен"}
@@ -1,5 +1,6 @@
 # Файл: tools/datetime_parser_tool.py
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Union, Tuple, Any
 
@@ -7,11 +8,16 @@ import dateparser  # Убедитесь, что dateparser установлен
 from pydantic import BaseModel, Field
 from langchain_core.tools import tool
 
-from src.gigachat_client import get_gigachat_client
+from src.gigachat_client import bounded_ainvoke, get_gigachat_client
 from src.schemas.data_schemas import DateTimeParserToolArgs
 
 logger = logging.getLogger(__name__)
 
+# LRU-кэш результатов разбора: "завтра" + "вечером" повторяются постоянно.
+# В ключ входит текущая дата, поэтому относительные даты устаревают в полночь.
+_PARSE_CACHE_MAX_SIZE = 1024
+_parse_cache: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+
 
 class TimeRangeResult(BaseModel):
     """
@@ -69,7 +75,9 @@ async def _parse_time_with_llm_flexible(
 """
     try:
         structured_llm_time = llm_instance.with_structured_output(TimeRangeResult)
-        parsed_response = await structured_llm_time.ainvoke(time_prompt_content)
+        parsed_response = await bounded_ainvoke(
+            structured_llm_time, time_prompt_content
+        )
         if not isinstance(parsed_response, TimeRangeResult):
             return TimeRangeResult()
         if (
@@ -79,9 +87,11 @@ async def _parse_time_with_llm_flexible(
             parsed_response.start_minute = 0
         if parsed_response.end_hour is not None and parsed_response.end_minute is None:
             parsed_response.end_minute = 0
-        logger.debug(
-            f"_parse_time_with_llm_flexible: LLM результат: {parsed_response.model_dump_json(indent=2)}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "_parse_time_with_llm_flexible: LLM результат: %s",
+                parsed_response.model_dump_json(),
+            )
         return parsed_response
     except Exception as e:
         logger.error(
@@ -277,12 +287,25 @@ async def datetime_parser_tool(
                                          (например, 'вечером', 'после 18:00').
     """
     base_datetime = datetime.now()
+    cache_key = (
+        natural_language_date.lower().strip(),
+        (natural_language_time_qualifier or "").lower().strip(),
+        base_datetime.date().isoformat(),
+    )
+    if (cached := _parse_cache.get(cache_key)) is not None:
+        _parse_cache.move_to_end(cache_key)
+        logger.debug(f"Разбор даты '{natural_language_date}' взят из кэша")
+        return dict(cached)
+
     parsed_date_info = python_date_parser(natural_language_date, base_datetime)
 
     if not parsed_date_info:
         logger.warning(f"Не удалось распознать дату: '{natural_language_date}'")
         return None
 
+    # Неудачный разбор времени через LLM не кэшируем, чтобы повторить попытку
+    is_cacheable = True
+
     # Теперь обрабатываем время
     if natural_language_time_qualifier:
         llm = get_gigachat_client()
@@ -292,6 +315,10 @@ async def datetime_parser_tool(
         parsed_time_info = await _parse_time_with_llm_flexible(
             time_qualifier, base_dt_for_time, llm
         )
+        is_cacheable = (
+            parsed_time_info.start_hour is not None
+            or parsed_time_info.end_hour is not None
+        )
 
         # Если время успешно извлечено, применяем его к дате
         if parsed_time_info.start_hour is not None:
@@ -329,4 +356,8 @@ async def datetime_parser_tool(
         "clarification_needed": parsed_date_info["clarification_needed"],
     }
 
-    return result_dict
+    if is_cacheable:
+        _parse_cache[cache_key] = result_dict
+        if len(_parse_cache) > _PARSE_CACHE_MAX_SIZE:
+            _parse_cache.popitem(last=False)
+    return dict(result_dict)
@@ -1,6 +1,7 @@
 # Файл: src/utils/callbacks.py
 
 import logging
+from functools import lru_cache
 from typing import Any, Dict, List, Optional
 from uuid import UUID
 
@@ -29,7 +30,8 @@ class TokenUsageCallbackHandler(BaseCallbackHandler):
         **kwargs: Any,
     ) -> None:
         """Вызывается после каждого завершения работы LLM."""
-        token_usage = response.llm_output.get("token_usage", {})
+        # При стриминге (astream) llm_output может быть None
+        token_usage = (response.llm_output or {}).get("token_usage", {})
         if token_usage:
             prompt_tokens = token_usage.get("prompt_tokens", 0)
             completion_tokens = token_usage.get("completion_tokens", 0)
@@ -45,3 +47,12 @@ class TokenUsageCallbackHandler(BaseCallbackHandler):
                 f"Completion Tokens: {completion_tokens}, "
                 f"Total Tokens: {total_tokens}"
             )
+
+
+@lru_cache(maxsize=256)
+def get_token_callback(node_name: str) -> TokenUsageCallbackHandler:
+    """
+    Возвращает общий обработчик для узла вместо создания нового на каждый вызов.
+    Счетчики такого обработчика накапливаются за все время работы процесса.
+    """
+    return TokenUsageCallbackHandler(node_name=node_name)
@@ -0,0 +1,227 @@
+import pytest
+from collections import deque
+from datetime import datetime
+
+from src.schemas.data_schemas import (
+    ChangeRequest,
+    Constraint,
+    Event,
+    FoodPlaceInfo,
+    PlanBuilderResult,
+    PossibleActions,
+)
+from src.agent_core.nodes import (
+    _apply_constraints,
+    _apply_constraints_with_expansion,
+    _get_candidate_price,
+    _parse_avg_bill,
+    router_node,
+)
+
+
+def make_event(session_id, start, min_price=None, rating=None):
+    """Создает событие Афиши с минимально необходимыми полями"""
+    return Event(
+        session_id=session_id,
+        name=f"Фильм {session_id}",
+        user_event_type_key="MOVIE",
+        place_name="Левый берег",
+        start_time_iso=start.isoformat(),
+        start_time_naive_event_tz=start,
+        min_price=min_price,
+        rating=rating,
+    )
+
+
+def make_food_place(id_gis, avg_bill_str):
+    """Создает заведение 2ГИС с заданной строкой среднего чека"""
+    return FoodPlaceInfo(id_gis=id_gis, name=f"Кафе {id_gis}", avg_bill_str=avg_bill_str)
+
+
+class TestPriceParsing:
+    """Тесты извлечения цены кандидата"""
+
+    @pytest.mark.parametrize(
+        "avg_bill_str, expected",
+        [
+            ("1000–1500 ₽", 1000.0),
+            ("1 200 ₽", 1200.0),
+            ("от 700 руб.", 700.0),
+            ("Средний чек не указан", None),
+        ],
+    )
+    def test_parse_avg_bill(self, avg_bill_str, expected):
+        assert _parse_avg_bill(avg_bill_str) == expected
+
+    def test_event_price_is_min_price(self):
+        event = make_event(1, datetime(2025, 9, 15, 19, 0), min_price=350)
+        assert _get_candidate_price(event) == 350.0
+
+    def test_event_without_price(self):
+        event = make_event(1, datetime(2025, 9, 15, 19, 0))
+        assert _get_candidate_price(event) is None
+
+    def test_food_place_price_from_avg_bill(self):
+        place = make_food_place("rest_1", "1 500–2 000 ₽")
+        assert _get_candidate_price(place) == 1500.0
+
+
+class TestConstraintFilters:
+    """Тесты фильтрации кандидатов по ограничениям команды 'modify'"""
+
+    def test_price_less_than_for_food_places(self):
+        candidates = [
+            make_food_place("rest_1", "1200 ₽"),
+            make_food_place("rest_2", "2500 ₽"),
+            make_food_place("rest_3", "800–1000 ₽"),
+        ]
+        constraints = [Constraint(attribute="price", operator="LESS_THAN", value="1500")]
+
+        result = _apply_constraints(candidates, constraints)
+
+        assert [c.id_gis for c in result] == ["rest_1", "rest_3"]
+
+    def test_price_filter_skips_candidates_without_price(self):
+        # Неоднородный столбец: у одного кандидата цены нет
+        candidates = [
+            make_event(1, datetime(2025, 9, 15, 19, 0), min_price=300),
+            make_event(2, datetime(2025, 9, 15, 20, 0)),
+            make_event(3, datetime(2025, 9, 15, 21, 0), min_price=900),
+        ]
+        constraints = [Constraint(attribute="price", operator="LESS_THAN", value="500")]
+
+        result = _apply_constraints(candidates, constraints)
+
+        assert [c.session_id for c in result] == [1]
+
+    def test_rating_greater_than(self):
+        candidates = [
+            make_event(1, datetime(2025, 9, 15, 19, 0), rating=7.5),
+            make_event(2, datetime(2025, 9, 15, 20, 0), rating=None),
+            make_event(3, datetime(2025, 9, 15, 21, 0), rating=8.9),
+        ]
+        constraints = [Constraint(attribute="rating", operator="GREATER_THAN", value="8")]
+
+        result = _apply_constraints(candidates, constraints)
+
+        assert [c.session_id for c in result] == [3]
+
+    def test_sort_operator_keeps_only_candidates_with_value(self):
+        candidates = [
+            make_event(1, datetime(2025, 9, 15, 19, 0), rating=7.5),
+            make_event(2, datetime(2025, 9, 15, 20, 0), rating=None),
+        ]
+        constraints = [Constraint(attribute="rating", operator="MAX")]
+
+        result = _apply_constraints(candidates, constraints)
+
+        assert [c.session_id for c in result] == [1]
+
+    def test_combined_constraints(self):
+        candidates = [
+            make_event(1, datetime(2025, 9, 15, 19, 0), min_price=300, rating=8.5),
+            make_event(2, datetime(2025, 9, 15, 20, 0), min_price=300, rating=6.0),
+            make_event(3, datetime(2025, 9, 15, 21, 0), min_price=900, rating=9.0),
+        ]
+        constraints = [
+            Constraint(attribute="price", operator="LESS_THAN", value="500"),
+            Constraint(attribute="rating", operator="GREATER_THAN", value="8"),
+        ]
+
+        result = _apply_constraints(candidates, constraints)
+
+        assert [c.session_id for c in result] == [1]
+
+    def test_unparseable_value_matches_nothing(self):
+        candidates = [make_food_place("rest_1", "1200 ₽")]
+        constraints = [Constraint(attribute="price", operator="LESS_THAN", value="дешево")]
+
+        assert _apply_constraints(candidates, constraints) == []
+
+    def test_start_time_prefers_strict_match(self):
+        candidates = [
+            make_event(1, datetime(2025, 9, 15, 18, 0)),
+            make_event(2, datetime(2025, 9, 15, 18, 50)),
+        ]
+        constraints = [
+            Constraint(
+                attribute="start_time", operator="LESS_THAN", value="2025-09-15T18:40:00"
+            )
+        ]
+
+        result, expanded = _apply_constraints_with_expansion(
+            candidates, constraints, expansion_minutes=15
+        )
+
+        assert [c.session_id for c in result] == [1]
+        assert expanded is False
+
+    def test_start_time_falls_back_to_expanded_range(self):
+        candidates = [
+            make_event(1, datetime(2025, 9, 15, 18, 50)),
+            make_event(2, datetime(2025, 9, 15, 19, 30)),
+        ]
+        constraints = [
+            Constraint(
+                attribute="start_time", operator="LESS_THAN", value="2025-09-15T18:40:00"
+            )
+        ]
+
+        result, expanded = _apply_constraints_with_expansion(
+            candidates, constraints, expansion_minutes=15
+        )
+
+        assert [c.session_id for c in result] == [1]
+        assert expanded is True
+
+
+class TestRouterCommandDispatch:
+    """Тесты диспетчеризации очереди команд в router_node"""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "command, expected_action",
+        [
+            ("modify", PossibleActions.REFINE_PLAN),
+            ("delete", PossibleActions.DELETE_ACTIVITY),
+            ("add", PossibleActions.ADD_ACTIVITY),
+            ("reorder", PossibleActions.PRESENT_RESULTS),
+        ],
+    )
+    async def test_command_queue_dispatch(self, command, expected_action):
+        state = {"command_queue": deque([ChangeRequest(command=command)])}
+
+        result_state = await router_node(state)
+
+        assert result_state["next_action"] == expected_action
+
+    @pytest.mark.asyncio
+    async def test_update_criteria_resets_candidates(self):
+        state = {
+            "command_queue": deque([ChangeRequest(command="update_criteria")]),
+            "cached_candidates": {"2025-09-15": {"MOVIE": []}},
+            "pinned_items": {"MOVIE": None},
+        }
+
+        result_state = await router_node(state)
+
+        assert result_state["next_action"] == PossibleActions.SEARCH_EVENTS
+        assert result_state["cached_candidates"] == {}
+        assert result_state["pinned_items"] == {}
+
+    @pytest.mark.asyncio
+    async def test_failed_build_drops_remaining_commands(self):
+        state = {
+            "plan_builder_result": PlanBuilderResult(failure_reason="Нет вариантов"),
+            "command_queue": deque([ChangeRequest(command="delete", target="PARK")]),
+        }
+
+        result_state = await router_node(state)
+
+        assert result_state["next_action"] == PossibleActions.PRESENT_RESULTS
+        assert result_state["error"] == "Нет вариантов"
+        assert len(result_state["command_queue"]) == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
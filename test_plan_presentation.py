@@ -12,11 +12,19 @@ from src.schemas.data_schemas import (
     Plan,
 )
 from src.agent_core.nodes import presenter_node
+from src.gigachat_client import reset_gigachat_client
 
 
 class TestPlanPresentation:
     """Тест для проверки логики отображения плана"""
 
+    @pytest.fixture(autouse=True)
+    def reset_llm_client(self):
+        """Сбрасываем общий клиент GigaChat: каждый тест идет в своем цикле событий"""
+        reset_gigachat_client()
+        yield
+        reset_gigachat_client()
+
     @pytest.fixture
     def mock_external_apis(self):
         """Мокаем внешние API с реалистичными данными"""